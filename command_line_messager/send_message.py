@@ -11,6 +11,8 @@
 
 # License: GPLv3
 
+# v2.2 - Added --socket, which sends the message over the XMPP bridge's Unix
+#   domain socket instead of TCP.  Needs requests-unixsocket.
 # v2.1 - Reformatted many of the references to use double-quotes, like the rest
 #   of my stuff.
 #       - Changed some print()s to logging.fatal()s.
@@ -26,6 +28,7 @@ import json
 import logging
 import requests
 import sys
+import urllib.parse
 
 # Global variables.
 # Handle to an argument parser.
@@ -81,6 +84,10 @@ argparser.add_argument("--hostname", action="store", default="localhost",
 argparser.add_argument("--port", action="store", default=8003,
     help="Specify the network port of an XMPP bridge to contact.  Defaults to 8003/tcp.")
 
+# Set up the path to the XMPP bridge's Unix domain socket, if it has one.
+argparser.add_argument("--socket", action="store",
+    help="Specify the path to the Unix domain socket of an XMPP bridge on the same machine.  Overrides --hostname and --port.")
+
 # Define the name of a message queue to send messages to.
 argparser.add_argument("--queue", action="store", default="replies",
     help="Specify a message queue of an XMPP bridge to contact.  Defaults to /replies.")
@@ -110,8 +117,19 @@ if not args.message and not args.infile:
 logger.debug("Command line arguments presented to the script:")
 logger.debug(str(args))
 
-# Assemble the URL of the XMPP bridge to contact.
-message_queue = "http://" + args.hostname + ":" + str(args.port) + "/" + args.queue.strip("/")
+# Assemble the URL of the XMPP bridge to contact.  Requests doesn't speak
+# http+unix:// on its own, so if the bridge is being contacted over its Unix
+# domain socket, teach it how.
+if args.socket:
+    try:
+        import requests_unixsocket
+    except ImportError:
+        logging.fatal("You need to install requests-unixsocket to use --socket.")
+        sys.exit(1)
+    requests_unixsocket.monkeypatch()
+    message_queue = "http+unix://" + urllib.parse.quote(args.socket, safe="") + "/" + args.queue.strip("/")
+else:
+    message_queue = "http://" + args.hostname + ":" + str(args.port) + "/" + args.queue.strip("/")
 
 # Set up custom headers.
 headers = {"Content-type": "application/json"}
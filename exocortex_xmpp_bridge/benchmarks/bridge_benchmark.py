@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# bridge_benchmark.py - End to end load test for exocortex_xmpp_bridge.py.
+#   Runs the whole bridge (REST API server, message queues, and the real
+#   XMPPClient with its replies processor) in one process without an XMPP
+#   server: commands are fed straight into XMPPClient.message() as if the
+#   owner had sent them, and XMPPClient.send_message() is replaced with a stub
+#   that writes down every reply stanza that would have gone out.  A bunch of
+#   simulated bots long-poll their queues over HTTP and PUT a reply for every
+#   command they get.
+#
+#   Reports how many commands per second made the whole trip, percentiles of
+#   how long it took from a bot PUTting a reply to the reply going out as a
+#   stanza (and from the command coming in to its reply going out), and how
+#   much the process grew.  Exits with an error if any command never got its
+#   reply, or if throughput is below --min-rate, so it can be run as a
+#   regression check.  Doesn't need a network connection.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.1 - Only stanzas carrying bots' replies are counted, not the bridge's
+#        acknowledgements of the commands.
+# v1.0 - Initial release.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import math
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+
+import message_queue
+import rest
+import xmppclient
+
+# Owner and bridge JIDs.  Nothing ever connects to them.
+owner = "owner@localhost"
+bridge = "bridge@localhost"
+
+# Replies the simulated bots send look like "done <command number>".
+done = re.compile(r"done (\d+)")
+
+# Every stanza that carries bots' replies starts with this.  Everything else
+# the bridge sends (acknowledging commands, mostly) doesn't count.
+reply_header = "Got a message from"
+
+# QuietRESTRequestHandler: The bridge's REST API handler with the per-request
+#   access logging turned off so that it doesn't skew the numbers.
+class QuietRESTRequestHandler(rest.RESTRequestHandler):
+
+    # Throw away the access log line that BaseHTTPRequestHandler writes to
+    # stderr for every request.
+    def log_message(self, format, *args):
+        return
+
+# FakeMessage: Just enough of a SliXMPP message stanza for
+#   XMPPClient.message().
+class FakeMessage(dict):
+
+    # Initialize new instances of the class.  Takes one arg, the body of the
+    # message.
+    def __init__(self, body):
+        dict.__init__(self, body=body, type="chat")
+
+    # Who the message is from, which is always the owner.
+    def get_from(self):
+        return owner + "/benchmark"
+
+# Results: Timestamps of everything that happens to every command, shared by
+#   the simulated bots and the stub that stands in for sending stanzas.
+class Results(object):
+
+    # Initialize new instances of the class.  sent, replied, and delivered
+    # are keyed by command number, and the values are times from
+    # time.monotonic().  stanzas is the number of reply stanzas sent.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.replied = {}
+        self.delivered = {}
+        self.stanzas = 0
+
+    # The stand-in for XMPPClient.send_message().  Any command numbers in a
+    # reply stanza have made the whole trip.  Stanzas that aren't replies
+    # from bots are ignored.
+    def send_message(self, mto, mbody, mtype):
+        now = time.monotonic()
+
+        if not mbody.startswith(reply_header):
+            return
+        with self.lock:
+            self.stanzas += 1
+            for number in done.findall(mbody):
+                self.delivered.setdefault(int(number), now)
+        return
+
+# rss(): The process's resident set size in kilobytes.
+def rss():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# percentile(): Nearest-rank percentile of a sorted list.
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+# bot(): Simulated bot.  Long-polls its message queue over one persistent
+#   connection and PUTs a reply for every command it gets, until stop is set.
+def bot(port, agent, batch, results, stop):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    response = None
+    commands = []
+
+    while not stop.is_set():
+        connection.request("GET", "/%s?wait=0.5&max=%d" % (agent, batch))
+        response = json.loads(connection.getresponse().read())
+        commands = response["commands"]
+        if not commands:
+            continue
+        replies = [{"name": agent, "reply": "done " + command.split()[-1]}
+            for command in commands]
+        with results.lock:
+            for command in commands:
+                results.replied[int(command.split()[-1])] = time.monotonic()
+        connection.request("PUT", "/replies", body=json.dumps(replies),
+            headers={"Content-Type": "application/json"})
+        connection.getresponse().read()
+    connection.close()
+    return
+
+# drive(): Feed commands into XMPPClient.message() on the event loop, keeping
+#   in_flight of them outstanding, until the deadline.  Then give the last
+#   replies a chance to go out.
+async def drive(client, bots, in_flight, deadline, results):
+    number = 0
+
+    while time.monotonic() < deadline:
+        while number - len(results.delivered) < in_flight:
+            results.sent[number] = time.monotonic()
+            client.message(FakeMessage("bot%d, job %d" % (number % bots,
+                number)))
+            number += 1
+        await asyncio.sleep(0.001)
+
+    drain = time.monotonic() + 5
+    while len(results.delivered) < number and time.monotonic() < drain:
+        await asyncio.sleep(0.01)
+    return number
+
+# benchmark(): Run the load test.  Returns a hash table of the results.
+async def benchmark(args):
+    results = Results()
+    stop = threading.Event()
+    threads = []
+    server = None
+    client = None
+
+    for i in range(args.bots):
+        message_queue.add_queue("bot%d" % i)
+    message_queue.build_routes()
+
+    server = rest.BoundedThreadingHTTPServer(("127.0.0.1", 0),
+        QuietRESTRequestHandler, args.workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The real XMPP client, with its replies processor running on this event
+    # loop, except that it never connects and its stanzas go to the stub.
+    client = xmppclient.XMPPClient(bridge, "benchmark", owner,
+        args.replies_rate, args.replies_burst, args.coalesce_window)
+    client.send_message = results.send_message
+    client.online = True
+
+    for i in range(args.bots):
+        threads.append(threading.Thread(target=bot, args=(
+            server.server_address[1], "bot%d" % i, args.batch, results,
+            stop), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    memory = rss()
+    start = time.monotonic()
+    issued = await drive(client, args.bots, args.in_flight,
+        start + args.duration, results)
+    elapsed = time.monotonic() - start
+    memory = rss() - memory
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    client.cancel_schedule("replies_processor")
+
+    with results.lock:
+        reply_latency = sorted(results.delivered[i] - results.replied[i]
+            for i in results.delivered if i in results.replied)
+        round_trip = sorted(results.delivered[i] - results.sent[i]
+            for i in results.delivered)
+    return { "issued": issued, "delivered": len(results.delivered),
+        "stanzas": results.stanzas, "elapsed": elapsed,
+        "reply latency": reply_latency, "round trip": round_trip,
+        "memory": memory }
+
+# Core code...
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Measures how many commands per second make it all the way through the XMPP bridge and back, and how long replies wait to go out, without an XMPP server.")
+    argparser.add_argument("--bots", action="store", type=int, default=20,
+        help="Number of simulated bots.  Defaults to 20.")
+    argparser.add_argument("--duration", action="store", type=float,
+        default=5.0, help="Seconds to run for.  Defaults to 5.")
+    argparser.add_argument("--in-flight", action="store", type=int,
+        default=200, help="Number of commands kept outstanding at once.  Defaults to 200.")
+    argparser.add_argument("--batch", action="store", type=int, default=10,
+        help="Most commands a bot takes per poll.  Defaults to 10.")
+    argparser.add_argument("--workers", action="store", type=int, default=64,
+        help="max_workers for the REST API server.  Defaults to 64.")
+    argparser.add_argument("--replies-rate", action="store", type=float,
+        default=100000, help="replies_rate for the XMPP client.  Defaults to 100000, high enough that the token bucket isn't what's being measured.")
+    argparser.add_argument("--replies-burst", action="store", type=int,
+        default=1000, help="replies_burst for the XMPP client.  Defaults to 1000.")
+    argparser.add_argument("--coalesce-window", action="store", type=float,
+        default=0, help="coalesce_window (in milliseconds) for the XMPP client.  Defaults to 0.")
+    argparser.add_argument("--min-rate", action="store", type=float, default=0,
+        help="Exit with an error if fewer commands per second than this make it through.  Defaults to 0.")
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(benchmark(args))
+    rate = results["delivered"] / results["elapsed"]
+
+    print("%d simulated bots, %.1f seconds, %d commands in flight." %
+        (args.bots, args.duration, args.in_flight))
+    print("%d commands sent, %d replies delivered in %d stanzas: %.1f commands/second" %
+        (results["issued"], results["delivered"], results["stanzas"], rate))
+    for name in ("reply latency", "round trip"):
+        print("%-14s p50 %8.1fms   p95 %8.1fms   p99 %8.1fms" % (name,
+            percentile(results[name], 50) * 1000,
+            percentile(results[name], 95) * 1000,
+            percentile(results[name], 99) * 1000))
+    print("memory growth  %d kB" % results["memory"])
+
+    if results["delivered"] < results["issued"]:
+        print("FAILED: %d commands never got their replies." %
+            (results["issued"] - results["delivered"]))
+        sys.exit(1)
+    if rate < args.min_rate:
+        print("FAILED: fewer than %.1f commands/second." % args.min_rate)
+        sys.exit(1)
+    sys.exit(0)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# journal_benchmark.py - Measures what the message queue journal costs.  Adds a
+#   bunch of commands to a message queue (and then takes them all back out)
+#   with the journal turned off and then turned on, and reports how many
+#   operations per second each way managed.  With the journal on, it also
+#   reports how long it took for everything to actually make it to disk.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+
+import journal
+import message_queue
+
+# benchmark(): Push count commands into a fresh message queue and pull them
+#   back out.  Takes the number of commands and the journal's commit interval
+#   in seconds (or None to run without a journal).  Returns the enqueue rate,
+#   the dequeue rate, and the number of seconds it took for the journal to
+#   catch up afterward.
+def benchmark(count, commit_interval):
+    queue = message_queue.AgentQueue("benchmark")
+    directory = None
+    catch_up = 0.0
+
+    message_queue.journal = None
+    if commit_interval is not None:
+        directory = tempfile.TemporaryDirectory()
+        message_queue.journal = journal.Journal(os.path.join(directory.name,
+            "journal.db"), commit_interval)
+        message_queue.journal.start()
+
+    start = time.perf_counter()
+    for i in range(count):
+        queue.put("get https://www.example.com/file%d.tar.gz" % i)
+    enqueue_rate = count / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    while queue.get() is not None:
+        pass
+    dequeue_rate = count / (time.perf_counter() - start)
+
+    if message_queue.journal:
+        start = time.perf_counter()
+        message_queue.journal.stop()
+        catch_up = time.perf_counter() - start
+        message_queue.journal = None
+        directory.cleanup()
+    return (enqueue_rate, dequeue_rate, catch_up)
+
+# Core code...
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Measures how much the message queue journal slows down the XMPP bridge's message queues.")
+    argparser.add_argument("--count", action="store", type=int, default=100000,
+        help="Number of commands to push through the queue.  Defaults to 100000.")
+    argparser.add_argument("--commit-interval", action="store", type=float,
+        default=50, help="Journal commit interval in milliseconds.  Defaults to 50.")
+    args = argparser.parse_args()
+
+    print("%d commands." % args.count)
+    for label, interval in (("journal off", None),
+            ("journal on", args.commit_interval / 1000.0)):
+        enqueue_rate, dequeue_rate, catch_up = benchmark(args.count, interval)
+        print("%-12s %10.0f enqueues/second %10.0f dequeues/second   %.2f seconds to catch up" %
+            (label, enqueue_rate, dequeue_rate, catch_up))
+    sys.exit(0)
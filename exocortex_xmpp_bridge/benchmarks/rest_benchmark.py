@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# rest_benchmark.py - Benchmark for the REST API part of
+#   exocortex_xmpp_bridge.py.  Starts the REST API server in a separate
+#   process (so it doesn't have to fight the simulated bots for the GIL),
+#   spins up a bunch of simulated bots that poll their message queues as fast
+#   as they can, and reports how many requests per second the server handled.
+#   Optionally, one of the "bots" opens a connection and then stalls, which
+#   shows what a single slow client does to everybody else.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.1 - Added --keepalive, which makes the simulated bots reuse one
+#        connection apiece instead of opening a new one for every request.
+# v1.0 - Initial release.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+from http.server import HTTPServer
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+
+import message_queue
+import rest
+
+# QuietRESTRequestHandler: The bridge's REST API handler with the per-request
+#   access logging turned off so that it doesn't skew the numbers.
+class QuietRESTRequestHandler(rest.RESTRequestHandler):
+    def log_message(self, format, *args):
+        return
+
+# run_server(): Start a REST API server in the given mode and serve requests
+#   until killed.  Takes the server mode, the number of worker threads, the
+#   number of agents to create queues for, and a multiprocessing.Queue to send
+#   the port the server is listening on back through.
+def run_server(mode, workers, agents, port_queue):
+    for i in range(agents):
+        message_queue.add_queue("bot%d" % i)
+    if mode == "single":
+        server = HTTPServer(("127.0.0.1", 0), QuietRESTRequestHandler)
+    else:
+        server = rest.BoundedThreadingHTTPServer(("127.0.0.1", 0),
+            QuietRESTRequestHandler, workers)
+    # Bots that give up on the server show up as broken pipes.  That's
+    # expected, so don't spray tracebacks all over the results.
+    server.handle_error = lambda request, client_address: None
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+# poll(): Simulated bot that hits its message queue over and over until the
+#   deadline passes.  Takes the server's port, the name of the agent, the
+#   deadline, whether or not to reuse the connection, and a list to append the
+#   bot's request count to.  Requests that are still outstanding when the
+#   deadline passes are abandoned.
+def poll(port, agent, deadline, keepalive, results):
+    requests = 0
+    connection = None
+    while time.monotonic() < deadline:
+        if not connection:
+            connection = http.client.HTTPConnection("127.0.0.1", port,
+                timeout=max(0.1, deadline - time.monotonic()))
+        try:
+            connection.request("GET", "/" + agent)
+            connection.getresponse().read()
+            requests += 1
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = None
+            continue
+        if not keepalive:
+            connection.close()
+            connection = None
+    if connection:
+        connection.close()
+    results.append(requests)
+
+# stall(): Simulated broken bot that opens a connection, sends half of a
+#   request, and then sits there until the deadline passes.
+def stall(port, deadline):
+    connection = socket.create_connection(("127.0.0.1", port))
+    connection.sendall(b"GET /bot0 HTTP/1.1\r\n")
+    time.sleep(max(0, deadline - time.monotonic()))
+    connection.close()
+
+# benchmark(): Run one round of the benchmark.  Returns the number of requests
+#   per second the server handled.
+def benchmark(mode, workers, bots, duration, slow_client, keepalive):
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server,
+        args=(mode, workers, bots, port_queue), daemon=True)
+    server.start()
+    port = port_queue.get()
+
+    results = []
+    threads = []
+    deadline = time.monotonic() + duration
+    if slow_client:
+        threads.append(threading.Thread(target=stall, args=(port, deadline)))
+    for i in range(bots):
+        threads.append(threading.Thread(target=poll,
+            args=(port, "bot%d" % i, deadline, keepalive, results)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    server.terminate()
+    server.join()
+    return sum(results) / duration
+
+# Core code...
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Measures how many polling requests per second the XMPP bridge's REST API can handle.")
+    argparser.add_argument("--bots", action="store", type=int, default=50,
+        help="Number of simulated bots polling the server.  Defaults to 50.")
+    argparser.add_argument("--duration", action="store", type=float,
+        default=5.0, help="Seconds to run each round for.  Defaults to 5.")
+    argparser.add_argument("--workers", action="store", type=int, default=64,
+        help="max_workers for threaded mode.  Defaults to 64.")
+    argparser.add_argument("--modes", action="store", default="single,threaded",
+        help="Comma separated list of server modes to test.  Defaults to single,threaded.")
+    argparser.add_argument("--keepalive", action="store_true",
+        help="Reuse one persistent connection per simulated bot.")
+    args = argparser.parse_args()
+
+    print("%d simulated bots, %.1f seconds per round, %s connections." %
+        (args.bots, args.duration,
+        "persistent" if args.keepalive else "one-shot"))
+    for mode in args.modes.split(","):
+        for slow_client in (False, True):
+            rate = benchmark(mode, args.workers, args.bots, args.duration,
+                slow_client, args.keepalive)
+            print("%-9s %-22s %10.1f requests/second" % (mode,
+                "with a stalled client" if slow_client else "", rate))
+    sys.exit(0)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# dedup.py - A module of the Exocortex XMPP Bridge that remembers the
+#   commands that were recently sent to each agent, so that when a flaky XMPP
+#   client (or a double-tap) sends the same command twice the bot doesn't
+#   run it twice.
+#
+#   Commands are compared without regard to case or extra whitespace.  How
+#   long a command is remembered for (its window) can be different for every
+#   agent, and agents without one aren't checked at all.  No more than
+#   max_entries commands are remembered at a time; past that, the ones sent
+#   longest ago are forgotten first.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+from collections import OrderedDict
+
+import sys
+import threading
+import time
+
+# Number of seconds commands sent to each agent are remembered for, keyed by
+# agent name.  Agents that aren't in here aren't checked for duplicates.
+windows = {}
+
+# Upper limit on the number of commands remembered.
+max_entries = 10000
+
+# Commands that were sent recently, keyed by (agent name, normalized command)
+# tuples.  The values are (time sent, time forgotten) tuples from
+# time.monotonic().  Least recently sent first.
+recent = OrderedDict()
+lock = threading.Lock()
+
+# set_window(): Set how long the commands sent to an agent are remembered.
+#   Takes two args, the name of the agent and the number of seconds (0 turns
+#   checking for duplicates off).
+def set_window(agent, window):
+    with lock:
+        if window > 0:
+            windows[agent] = window
+        else:
+            windows.pop(agent, None)
+    return
+
+# normalize(): Put a command into the form it's compared in.
+def normalize(command):
+    return " ".join(command.casefold().split())
+
+# seen(): Check whether a command was sent to an agent within its window.
+#   Takes two args, the name of the agent and the command.  Returns the
+#   number of seconds since it was sent, or None if it wasn't.
+def seen(agent, command):
+    now = time.monotonic()
+    entry = None
+
+    if agent not in windows:
+        return None
+    with lock:
+        _expire(now)
+        entry = recent.get((agent, normalize(command)))
+    if not entry or entry[1] <= now:
+        return None
+    return now - entry[0]
+
+# remember(): Write down that a command was sent to an agent.  Takes two args,
+#   the name of the agent and the command.
+def remember(agent, command):
+    now = time.monotonic()
+    key = (agent, normalize(command))
+
+    if agent not in windows:
+        return
+    with lock:
+        recent[key] = (now, now + windows[agent])
+        recent.move_to_end(key)
+        _expire(now)
+    return
+
+# Forget the oldest commands if there are too many, and any at the front of
+# the line whose windows have closed.  Windows are different for every agent,
+# so a command whose window has closed can be stuck behind one whose window
+# hasn't for a while; seen() ignores it.  The caller has to be holding the
+# lock.
+def _expire(now):
+    while recent:
+        if len(recent) <= max_entries and next(iter(recent.values()))[1] > now:
+            break
+        recent.popitem(last=False)
+    return
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
@@ -15,6 +15,54 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v6.17 - Every leaf has a shared secret.  leaves is a list of name:secret
+#        pairs now, and added the configuration setting hub_secret (on the
+#        leaves).
+# v6.16 - Commands that repeat one sent to the same agent within dedup_window
+#        seconds are dropped (dedup.py).  Added the configuration setting
+#        dedup_window, which works the same way as the queue limits.
+# v6.15 - Added the configuration setting compress_threshold, the size at which
+#        REST API responses are compressed with gzip.
+# v6.14 - Bridges on different machines can share one XMPP session
+#        (federation.py).  Added the configuration settings leaves (on the
+#        hub), and hub and leaf_name (on the leaves).  A leaf doesn't need
+#        owner, username, or password.
+# v6.13 - The REST API can also listen on a Unix domain socket.  Added the
+#        configuration setting unix_socket.
+# v6.12 - Builds a routing index of agent names at startup so that
+#        commands reach the right agent even if its name is capitalized
+#        wrong, misspelled by a letter, or given by an alias.  Added the
+#        configuration setting aliases.
+# v6.11 - Added scheduled commands (scheduler.py).  Added the configuration
+#        settings scheduling and schedule_file.
+# v6.10 - Added priority lanes to the message queues.  Added the
+#        configuration settings high_priority, low_priority, and
+#        priority_aging, which work the same way as the queue limits.
+# v6.9 - Message queues can be limited in size.  Added the configuration
+#        settings max_queue_length, max_queue_bytes, and queue_policy, which
+#        can be set for all queues in [DEFAULT] or for one queue in a section
+#        named after it.
+# v6.8 - Added optional end-to-end tracing of commands (tracing.py).  Added the
+#        configuration settings trace_file, trace_file_size, and
+#        trace_file_count.
+# v6.7 - Added an optional SQLite journal (journal.py) that the message queues
+#        are persisted to, so commands and replies survive a crash or a
+#        restart.  Added the configuration settings journal_file,
+#        journal_commit_interval, and journal_compact_interval.
+# v6.6 - Added the configuration settings coalesce_window and
+#        max_stanza_bytes, which merge bursts of replies from the same bot.
+# v6.5 - Replies are sent through a token bucket.  Added the configuration
+#        settings replies_rate and replies_burst.
+# v6.4 - The REST API speaks HTTP/1.1 with persistent connections now.  Added
+#        the configuration setting keepalive_timeout.
+# v6.3 - The REST API server can run in "threaded" mode (the default, with a
+#        cap on the number of worker threads) or the old "single" threaded
+#        mode.  Added the configuration settings server_mode and max_workers.
+# v6.2 - Message queues are now created with message_queue.add_queue().
+# v6.1 - Added long-polling support to the REST API.  Because parked requests
+#        would otherwise block every other bot, the REST API server now
+#        handles each request in its own thread.
+#      - Added the optional configuration setting longpoll_max_wait.
 # v6.0 - Changes to use SliXMPP.  Reworked some stuff to clean it up while I
 #        was at it.  Chief among them, declaring some of the globals rather
 #        than freestyling them later.  This may as well be a major release.
@@ -70,15 +118,8 @@
 # TODO:
 # - Write a signal handler that makes the agent reload its configuration file
 #   (whether it's the default one or specified on the command line).
-# - Consider adding a SQLite database to serialize the message queues to in
-#   the event the microservice ABENDs or gets shut down.  Don't forget a
-#   scream-and-die error message to not leave the user hanging.
 # - Maybe add a signal handler that'll cause the bot to dump its message queues
 #   to the database without dying?
-# - Figure out how to make slightly-mistyped search agent names (like all-
-#   lowercase instead of proper capitalization, or proper capitalization
-#   instead of all caps) match when search requests are pushed into the
-#   message queue.  I think I can do this, I just need to play with it.
 
 # By: The Doctor <drwho at virtadpt dot net>
 #     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
@@ -88,15 +129,26 @@
 from http.server import HTTPServer
 
 import argparse
+import atexit
 import configparser
+import itertools
 import json
 import logging
+import math
 import os
+import socket
+import sqlite3
+import stat
 import sys
 import _thread
 
+import dedup
+import federation
+import journal
 import message_queue
 import rest
+import scheduler
+import tracing
 import xmppclient
 
 # Globals.
@@ -105,6 +157,73 @@ import xmppclient
 listenon_host = "localhost"
 listenon_port = 8003
 
+# Path to a Unix domain socket the REST API server also listens on, for bots
+# running on the same machine.  If it isn't set, the REST API server only
+# listens on TCP.
+unix_socket = ""
+
+# Maximum number of seconds a long-polling request to the REST API can park
+# for.
+longpoll_max_wait = 60
+
+# Whether the REST API server handles requests in parallel ("threaded") or
+# one at a time ("single"), and how many requests it'll handle at once in
+# threaded mode.
+server_mode = "threaded"
+max_workers = 64
+
+# Number of seconds an idle persistent connection to the REST API is kept
+# open.
+keepalive_timeout = 30
+
+# REST API responses at least this many bytes long are compressed with gzip
+# for clients that can take it.  0 turns compression off.
+compress_threshold = 1024
+
+# Number of replies per second that can be sent to the bot's owner, and how
+# many can go out back to back.
+replies_rate = 5.0
+replies_burst = 10
+
+# Replies from the same bot that arrive within this many milliseconds of each
+# other are merged into one message of at most max_stanza_bytes.  Replies
+# bigger than that are split into numbered parts.
+coalesce_window = 0
+max_stanza_bytes = 8192
+
+# Path to the SQLite database the message queues are journaled to, how often
+# (in milliseconds) changes are committed to it, and how often (in seconds)
+# it's cleaned out.  If journal_file isn't set, nothing is journaled.
+journal_file = ""
+journal_commit_interval = 50
+journal_compact_interval = 300
+
+# Whether commands can be scheduled to run later ("at 02:00 ..." or "in 30
+# minutes ..."), and the path to the SQLite database scheduled commands are
+# saved in.  If schedule_file isn't set, scheduled commands only exist in
+# memory.
+scheduling = False
+schedule_file = ""
+
+# Path to the file traces of commands are written to, how big it can get (in
+# megabytes) before it's rotated, and how many old ones to keep.  If
+# trace_file isn't set, nothing is traced.
+trace_file = ""
+trace_file_size = 10
+trace_file_count = 5
+
+# The leaf bridges that are allowed to federate with this one, which makes
+# this bridge the hub.  Keyed by name, the values are the secrets they share
+# with the hub.
+leaves = {}
+
+# URL of the hub's REST API, which makes this bridge a leaf, the name this
+# leaf goes by, and the secret it shares with the hub.  The name defaults to
+# the machine's hostname.
+hub = ""
+leaf_name = ""
+hub_secret = ""
+
 # JID of the bot's registered owner.
 owner = ""
 
@@ -147,27 +266,182 @@ def process_loglevel(loglevel):
     if loglevel == "notset":
         return 0
 
-# start_rest_server(): Wrapper function that starts an instance of HTTPServer
-#   in a thread so that it won't block execution.  Takes two args, a hostname
-#   or IP address to listen on, and a TCP port to listen on.  Doesn't return
-#   anything because it hangs off of a thread and runs until the bridge shuts
-#   down.
-def start_rest_server(host, port):
+# set_queue_limits(): Set the limits on a message queue from the config
+#   file.  They can be set in a section named after the queue, which falls
+#   back to whatever's in [DEFAULT].  Takes one arg, the name of the queue.
+def set_queue_limits(name):
+    logger.debug("Entered set_queue_limits().")
+    section = "DEFAULT"
+    max_length = 0
+    max_bytes = 0
+    policy = "reject"
+
+    if config.has_section(name):
+        section = name
+    try:
+        max_length = int(config.get(section, "max_queue_length", fallback=0))
+        max_bytes = int(config.get(section, "max_queue_bytes", fallback=0))
+        policy = config.get(section, "queue_policy", fallback="reject").lower()
+        message_queue.message_queue[name].set_limits(max_length, max_bytes,
+            policy)
+    except ValueError as e:
+        logger.error("Bad limits for message queue %s: %s" % (name, e))
+        sys.exit(1)
+    if max_length or max_bytes:
+        logger.debug("Message queue %s holds at most %d items and %d bytes, policy %s." %
+            (name, max_length, max_bytes, policy))
+    return
+
+# set_queue_priorities(): Set up a message queue's priority lanes from the
+#   config file, the same way as set_queue_limits().  Takes one arg, the name
+#   of the queue.
+def set_queue_priorities(name):
+    logger.debug("Entered set_queue_priorities().")
+    section = "DEFAULT"
+    high = []
+    low = []
+    aging = 30
+
+    if config.has_section(name):
+        section = name
+    high = [i.strip() for i in config.get(section, "high_priority",
+        fallback="").split(",") if i.strip()]
+    low = [i.strip() for i in config.get(section, "low_priority",
+        fallback="").split(",") if i.strip()]
+    try:
+        aging = float(config.get(section, "priority_aging", fallback=30))
+    except ValueError as e:
+        logger.error("Bad priority_aging for message queue %s: %s" % (name, e))
+        sys.exit(1)
+    message_queue.message_queue[name].set_priorities(high, low, aging)
+    if high or low:
+        logger.debug("Message queue %s: high priority %s, low priority %s, aging %s seconds." %
+            (name, high, low, aging))
+    return
+
+# set_dedup_window(): Set how long commands sent to an agent are remembered so
+#   that duplicates can be dropped, from the config file, the same way as
+#   set_queue_limits().  Takes one arg, the name of the agent's queue.
+def set_dedup_window(name):
+    logger.debug("Entered set_dedup_window().")
+    section = "DEFAULT"
+    window = 0.0
+
+    if config.has_section(name):
+        section = name
+    try:
+        window = float(config.get(section, "dedup_window", fallback=0))
+    except ValueError as e:
+        logger.error("Bad dedup_window for agent %s: %s" % (name, e))
+        sys.exit(1)
+    dedup.set_window(name, window)
+    if window:
+        logger.debug("Duplicate commands to agent %s are dropped for %s seconds." %
+            (name, window))
+    return
+
+# start_journal(): Open the message queue journal, put anything that was still
+#   waiting when the bridge last shut down back into the message queues, and
+#   start journaling.  Takes three args, the path to the journal, the commit
+#   interval in milliseconds, and the compaction interval in seconds.  Returns
+#   a handle to the journal.
+def start_journal(path, commit_interval, compact_interval):
+    logger.debug("Entered start_journal().")
+
+    queue_journal = None
+    entries = []
+    highest = 0
+
+    try:
+        queue_journal = journal.Journal(path, commit_interval / 1000.0,
+            compact_interval)
+        entries, highest = queue_journal.replay()
+    except sqlite3.Error as e:
+        logger.error("Unable to open the message queue journal %s: %s" %
+            (path, e))
+        sys.exit(1)
+
+    # Put everything that was still waiting back into its message queue.  If
+    # an agent's been removed from the config file in the meantime there's
+    # nothing to do with its commands, so they get dropped.  On a hub, agents
+    # that live on leaves don't have queues until their leaves connect, so
+    # their commands are held until then.
+    for seq, queue, item in entries:
+        if queue not in message_queue.message_queue and federation.allowed_leaves:
+            federation.park(queue, seq, json.loads(item))
+            continue
+        if queue not in message_queue.message_queue:
+            logger.warning("Dropping journaled entry for message queue %s, which doesn't exist anymore." %
+                queue)
+            queue_journal.record_ack(seq)
+            continue
+        message_queue.message_queue[queue].restore(seq, json.loads(item))
+    message_queue.sequence = itertools.count(highest + 1)
+    logger.info("Restored %d entries from the message queue journal." %
+        len(entries))
+    for queue in federation.parked:
+        logger.info("Holding %d journaled commands for agent %s until its leaf connects." %
+            (len(federation.parked[queue]), queue))
+
+    message_queue.journal = queue_journal
+    queue_journal.start()
+    atexit.register(queue_journal.stop)
+    return queue_journal
+
+# start_rest_server(): Wrapper function that starts the REST API server in a
+#   thread so that it won't block execution.  Takes four args, a hostname or IP
+#   address to listen on, a TCP port to listen on, the server mode ("threaded"
+#   or "single"), and the maximum number of worker threads in threaded mode.
+#   Doesn't return anything because it hangs off of a thread and runs until the
+#   bridge shuts down.
+def start_rest_server(host, port, mode, workers):
     logger.debug("Entered start_rest_server().")
 
     # Handle to an HTTPServer.
     api_server = None
 
-    # Allocate an instance of HTTPServer that listens on a particular IP and
-    # port, and instantiates my custom REST API object.
-    api_server = HTTPServer((host, port), rest.RESTRequestHandler)
+    # Allocate an HTTP server that listens on a particular IP and port, and
+    # instantiates my custom REST API object.  In threaded mode every request
+    # gets its own thread (up to a limit) so that slow clients and
+    # long-polling requests don't block anybody else.
+    if mode == "single":
+        api_server = HTTPServer((host, port), rest.RESTRequestHandler)
+    else:
+        api_server = rest.BoundedThreadingHTTPServer((host, port),
+            rest.RESTRequestHandler, workers)
     logger.debug(api_server)
-    logger.info("REST API server now listening on %s, port %s/tcp." %
-        (host, port))
+    logger.info("REST API server now listening on %s, port %s/tcp in %s mode." %
+        (host, port, mode))
 
     logger.debug("Kicking off the API server.")
     api_server.serve_forever()
 
+# start_unix_server(): Function that starts the REST API server on a Unix domain
+#   socket.  Takes the same arguments as start_rest_server(), except it takes
+#   the path to the socket instead of a host and port.
+def start_unix_server(path, mode, workers):
+    logger.debug("Entered start_unix_server().")
+
+    # Handle to an HTTPServer.
+    api_server = None
+
+    try:
+        if mode == "single":
+            api_server = rest.UnixHTTPServer(path, rest.RESTRequestHandler)
+        else:
+            api_server = rest.BoundedThreadingUnixHTTPServer(path,
+                rest.RESTRequestHandler, workers)
+    except OSError as e:
+        logger.error("Unable to listen on the Unix domain socket %s: %s" %
+            (path, e))
+        return
+    atexit.register(api_server.server_close)
+    logger.info("REST API server now listening on %s in %s mode." %
+        (path, mode))
+
+    logger.debug("Kicking off the API server on the Unix domain socket.")
+    api_server.serve_forever()
+
 # Core code...
 # Set up the command line argument parser.
 argparser = argparse.ArgumentParser(description="A construct that logs into an XMPP server with credentials from a configuration file, builds message queues for the other constructs listed in the config file, and listens for messages sent from the construct's designated owner.")
@@ -195,14 +469,191 @@ config.read(config_file)
 # Get configuration options from the configuration file.
 listenon_host = config.get("DEFAULT", "hostname")
 listenon_port = int(config.get("DEFAULT", "port"))
-owner = config.get("DEFAULT", "owner")
-username = config.get("DEFAULT", "username")
-password = config.get("DEFAULT", "password")
+owner = config.get("DEFAULT", "owner", fallback="")
+username = config.get("DEFAULT", "username", fallback="")
+password = config.get("DEFAULT", "password", fallback="")
 agents = config.get("DEFAULT", "agents")
 
+# Get the path to the Unix domain socket for the REST API, if there is one.
+try:
+    unix_socket = config.get("DEFAULT", "unix_socket")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the maximum long-polling time for the REST API.
+try:
+    longpoll_max_wait = float(config.get("DEFAULT", "longpoll_max_wait"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the REST API server's concurrency settings.
+try:
+    server_mode = config.get("DEFAULT", "server_mode").lower()
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+if server_mode not in ("threaded", "single"):
+    logging.error("server_mode must be either threaded or single, not %s." %
+        server_mode)
+    sys.exit(1)
+try:
+    max_workers = int(config.get("DEFAULT", "max_workers"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# A single-threaded server can't park requests without locking out every
+# other bot, so long-polling gets turned off in that mode.  (So do persistent
+# connections, in RESTRequestHandler.setup().)
+if server_mode == "single":
+    longpoll_max_wait = 0
+rest.RESTRequestHandler.max_wait = longpoll_max_wait
+
+# Get the idle timeout for persistent connections to the REST API.
+try:
+    keepalive_timeout = float(config.get("DEFAULT", "keepalive_timeout"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+rest.RESTRequestHandler.timeout = keepalive_timeout
+
+# Get the size at which responses from the REST API are compressed.
+try:
+    compress_threshold = int(config.get("DEFAULT", "compress_threshold"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+rest.RESTRequestHandler.compress_threshold = compress_threshold
+
+# Get the rate limits for sending replies to the bot's owner.
+try:
+    replies_rate = float(config.get("DEFAULT", "replies_rate"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    replies_burst = int(config.get("DEFAULT", "replies_burst"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# With either of these at zero (or less) the token bucket never has a whole
+# token in it, so no replies would ever go out.
+if not math.isfinite(replies_rate) or replies_rate <= 0:
+    logging.error("replies_rate must be a number greater than 0, not %s." %
+        replies_rate)
+    sys.exit(1)
+if replies_burst < 1:
+    logging.error("replies_burst must be at least 1, not %s." % replies_burst)
+    sys.exit(1)
+
+# Get the settings for the message queue journal.
+try:
+    journal_file = config.get("DEFAULT", "journal_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    journal_commit_interval = float(config.get("DEFAULT",
+        "journal_commit_interval"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    journal_compact_interval = float(config.get("DEFAULT",
+        "journal_compact_interval"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the settings for scheduled commands.
+try:
+    scheduling = config.getboolean("DEFAULT", "scheduling")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    schedule_file = config.get("DEFAULT", "schedule_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the settings for tracing commands.
+try:
+    trace_file = config.get("DEFAULT", "trace_file")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    trace_file_size = float(config.get("DEFAULT", "trace_file_size"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    trace_file_count = int(config.get("DEFAULT", "trace_file_count"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
+# Get the settings for federating with other bridges.
+try:
+    for i in config.get("DEFAULT", "leaves").split(","):
+        if not i.strip():
+            continue
+        name, _, secret = i.partition(":")
+        if not name.strip() or not secret.strip():
+            logging.error("Every leaf needs a name and a shared secret (leaves = name:secret,...), not %s." %
+                i.strip())
+            sys.exit(1)
+        leaves[name.strip()] = secret.strip()
+except configparser.NoOptionError:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    hub = config.get("DEFAULT", "hub")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    leaf_name = config.get("DEFAULT", "leaf_name")
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    hub_secret = config.get("DEFAULT", "hub_secret").strip()
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+if hub and not leaf_name:
+    leaf_name = socket.gethostname()
+if hub and not hub_secret:
+    logging.error("A leaf (hub is set) needs the hub_secret it shares with the hub.")
+    sys.exit(1)
+
+# Leaves long-poll the hub for their commands, which a single-threaded server
+# can't do (it would have them polling in a tight loop and lock everything else
+# out), so a hub has to be threaded.
+if leaves and server_mode != "threaded":
+    logging.error("A hub (leaves is set) needs server_mode = threaded.")
+    sys.exit(1)
+
+# Get the settings for merging replies.
+try:
+    coalesce_window = float(config.get("DEFAULT", "coalesce_window"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+try:
+    max_stanza_bytes = int(config.get("DEFAULT", "max_stanza_bytes"))
+except:
+    # Nothing to do here, it's an optional configuration setting.
+    pass
+
 # Get the names of the agents to set up queues for from the config file.
 for i in agents.split(','):
-    message_queue.message_queue[i] = []
+    message_queue.add_queue(i)
 
 # Figure out how to configure the logger.  Start by reading from the config
 # file.
@@ -221,21 +672,113 @@ logger = logging.getLogger(__name__)
 # In debug mode, output the configuration variables.
 logger.debug("Value of listenon_host: %s" % listenon_host)
 logger.debug("Value of listenon_port: %s" % listenon_port)
+logger.debug("Value of unix_socket: %s" % unix_socket)
 logger.debug("Value of owner: %s" % owner)
 logger.debug("Value of username: %s" % username)
 logger.debug("Value of password: %s" % password)
 logger.debug("Value of agents: %s" % agents)
+logger.debug("Value of longpoll_max_wait: %s" % longpoll_max_wait)
+logger.debug("Value of server_mode: %s" % server_mode)
+logger.debug("Value of max_workers: %s" % max_workers)
+logger.debug("Value of keepalive_timeout: %s" % keepalive_timeout)
+logger.debug("Value of compress_threshold: %s" % compress_threshold)
+logger.debug("Value of replies_rate: %s" % replies_rate)
+logger.debug("Value of replies_burst: %s" % replies_burst)
+logger.debug("Value of coalesce_window: %s" % coalesce_window)
+logger.debug("Value of max_stanza_bytes: %s" % max_stanza_bytes)
+logger.debug("Value of journal_file: %s" % journal_file)
+logger.debug("Value of journal_commit_interval: %s" % journal_commit_interval)
+logger.debug("Value of journal_compact_interval: %s" %
+    journal_compact_interval)
+logger.debug("Value of scheduling: %s" % scheduling)
+logger.debug("Value of schedule_file: %s" % schedule_file)
+logger.debug("Value of trace_file: %s" % trace_file)
+logger.debug("Value of trace_file_size: %s" % trace_file_size)
+logger.debug("Value of trace_file_count: %s" % trace_file_count)
+logger.debug("Value of leaves: %s" % leaves)
+logger.debug("Value of hub: %s" % hub)
+logger.debug("Value of leaf_name: %s" % leaf_name)
+logger.debug("Value of hub_secret: %s" % hub_secret)
+
+# Set the limits and priority lanes on the message queues, and how long
+# commands are remembered for so that duplicates can be dropped.
+for i in list(message_queue.message_queue.keys()):
+    set_queue_limits(i)
+    set_queue_priorities(i)
+    if i != "replies":
+        set_dedup_window(i)
+
+# Build the routing index of agent names, with any aliases the agents have in
+# their own sections of the config file.
+aliases = {}
+for i in list(message_queue.message_queue.keys()):
+    if config.has_section(i):
+        aliases[i] = [j.strip() for j in config.get(i, "aliases",
+            fallback="").split(",") if j.strip()]
+message_queue.build_routes(aliases)
+
+# If this bridge is a hub, leaves' agents get routed to along with its own,
+# and their message queues are set up the same way.
+federation.allowed_leaves = leaves
+federation.aliases = aliases
+federation.new_queue_hooks = [set_queue_limits, set_queue_priorities,
+    set_dedup_window]
+
+# If the message queues are being journaled, restore whatever was in them the
+# last time the bridge was running before anything can be added to them.
+if journal_file:
+    start_journal(journal_file, journal_commit_interval,
+        journal_compact_interval)
+
+# Turn on tracing, if it's configured.
+if trace_file:
+    try:
+        tracing.start(trace_file, int(trace_file_size * 1048576),
+            trace_file_count)
+    except OSError as e:
+        logger.error("Unable to open the trace file %s: %s" % (trace_file, e))
+        sys.exit(1)
+
+# Start the scheduler, if it's turned on.  Scheduled commands that came due
+# while the bridge was down are released right away.
+if scheduling:
+    try:
+        scheduler.schedule = scheduler.Scheduler(schedule_file or None)
+    except sqlite3.Error as e:
+        logger.error("Unable to open the schedule %s: %s" % (schedule_file, e))
+        sys.exit(1)
+    scheduler.schedule.start()
+    atexit.register(scheduler.schedule.stop)
 
 # Start the REST API server on a low-level thread.  It doesn't need to have
 # full thread functionality, it just has to have an object hanging off of it
 # with a running event loop.  We do this first because slixmpp.xmppclient runs
 # in the foreground, and I haven't figured out how to change that yet.
 # https://docs.python.org/3/library/_thread.html
-_thread.start_new_thread(start_rest_server, (listenon_host, listenon_port))
+_thread.start_new_thread(start_rest_server, (listenon_host, listenon_port,
+    server_mode, max_workers))
+# Don't let the REST API server replace something that isn't a socket, in
+# case unix_socket is a typo.
+if unix_socket and os.path.lexists(unix_socket) and not stat.S_ISSOCK(os.lstat(unix_socket).st_mode):
+    logger.error("%s already exists and isn't a socket, so the REST API server can't listen there." %
+        unix_socket)
+    sys.exit(1)
+if unix_socket:
+    _thread.start_new_thread(start_unix_server, (unix_socket, server_mode,
+        max_workers))
+
+# If this bridge is a leaf, it doesn't log into the XMPP server.  It gets its
+# agents' commands from the hub and sends its bots' replies there instead.
+if hub:
+    logger.info("Federating with the hub at %s as leaf %s." % (hub, leaf_name))
+    federation.Link(hub, leaf_name, hub_secret, [i for i in
+        message_queue.message_queue if i != "replies"], aliases).run()
+    sys.exit(0)
 
 # Instantiate the XMPP client module.
 logger.debug("Initializing the XMPP client object.")
-xmpp_client = xmppclient.XMPPClient(username, password, owner)
+xmpp_client = xmppclient.XMPPClient(username, password, owner, replies_rate,
+    replies_burst, coalesce_window, max_stanza_bytes)
 
 # Register some XEP plugins.
 xmpp_client.register_plugin("xep_0030") # Service discovery
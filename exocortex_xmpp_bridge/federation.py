@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# federation.py - A module of the Exocortex XMPP Bridge that lets bridges on
+#   different machines share one XMPP session.  One bridge (the hub) logs into
+#   the XMPP server as usual.  The others (leaves) don't log into anything;
+#   each one serves the bots on its own machine and keeps an HTTP link open
+#   to the hub:
+#
+#   - When a leaf starts up it registers its agents with the hub (PUT
+#     /federation/<leaf>), and the hub adds message queues for them and puts
+#     them into its routing index as if they were its own, aliases and all.
+#   - The leaf long-polls the hub (GET /federation/<leaf>) for commands for
+#     all of its agents at once, and puts them into its own message queues
+#     for its bots to pick up.  The commands are leased out of the hub's
+#     queues, and the leaf acknowledges them (PUT /federation/<leaf>/ack)
+#     once they're in its own queues.  Commands that aren't acknowledged in
+#     time (because the link dropped, or the agent's queue on the leaf was
+#     full) go back into the hub's queues and are sent again, so a command
+#     can occasionally get to a bot twice, but it's never lost.
+#   - The leaf sends its bots' replies to the hub in batches (PUT
+#     /federation/<leaf>/replies), which sends them to the owner over XMPP.
+#
+#   Everything that goes over the link is compressed with gzip.  Only leaves
+#   whose names are in the hub's configuration file are allowed to register,
+#   and every request a leaf makes has to carry the shared secret that goes
+#   with its name (Authorization: Bearer <secret>).
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.4 - Every leaf has a shared secret that it has to send to the hub with
+#        every request.  allowed_leaves is a hash table of leaf names and
+#        their secrets now.
+# v1.3 - Commands for leaf agents that are read back out of the journal when
+#        the hub starts up are held until the leaf registers the agent again,
+#        instead of being thrown away.
+# v1.2 - When a leaf registers again without some of its agents, they're
+#        taken out of the hub's message queues and routing index, and the
+#        owner is told about any commands that were waiting for them.
+# v1.1 - Commands are leased to leaves and acknowledged instead of being
+#        taken out of the hub's queues outright, so they aren't lost when the
+#        link drops or the leaf has no room for them.
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+from urllib.parse import urlsplit
+
+import gzip
+import hmac
+import http.client
+import json
+import logging
+import sys
+import threading
+import time
+
+import message_queue
+
+# Globals.
+# The leaves that are allowed to register with this bridge, keyed by name.
+# Values are the shared secrets they have to send.  If it's empty, this bridge
+# isn't a hub.
+allowed_leaves = {}
+
+# Leaves that have registered, keyed by name.  Values are RemoteLeaf objects.
+leaves = {}
+
+# The leaf that each remote agent belongs to, keyed by agent name.
+owners = {}
+
+# The hub's own aliases for its agents, which are merged with the aliases the
+# leaves send when the routing index is rebuilt.
+aliases = {}
+
+# Functions that are called with the name of every message queue that's
+# created for a remote agent, so that it can be set up the same way as the
+# hub's own queues (limits, priorities...)
+new_queue_hooks = []
+
+# Number of seconds a leaf has to acknowledge the commands it was sent before
+# they go back into the hub's queues.
+lease_time = 60
+
+# Commands for leaf agents that were read back out of the journal before the
+# agents' leaves registered them, keyed by agent name.  Values are lists of
+# (sequence number, command) tuples.
+parked = {}
+
+lock = threading.Lock()
+
+# RemoteLeaf: What the hub knows about a leaf that's registered with it.
+class RemoteLeaf(object):
+    def __init__(self, name):
+        self.name = name
+        self.agents = []
+        self.aliases = {}
+
+        # Last time (from time.time()) the leaf was heard from.
+        self.last_seen = 0.0
+
+        # Set whenever a command is added to the queue of one of the leaf's
+        # agents.
+        self.wakeup = threading.Event()
+
+# register(): Add a leaf's agents to the hub.  Agents that the hub doesn't
+#   have a message queue for yet get one.  Agents that belong to the hub
+#   itself or to another leaf are refused.  Agents the leaf had before but
+#   doesn't anymore are removed.  Takes three args, the name of the
+#   leaf, a list of its agents, and a hash table of their aliases.  Returns a
+#   tuple of the list of agents that were registered and the list that
+#   weren't.
+def register(name, agents, agent_aliases={}):
+    leaf = None
+    other = None
+    registered = []
+    refused = []
+    dropped = []
+    merged = {}
+
+    with lock:
+        leaf = leaves.setdefault(name, RemoteLeaf(name))
+        for agent in agents:
+            if agent == "replies" or (agent in message_queue.message_queue and
+                    owners.get(agent) != name):
+                logging.warning("Leaf %s tried to register agent %s, which is already somebody else's." %
+                    (name, agent))
+                refused.append(agent)
+                continue
+            if agent not in message_queue.message_queue:
+                message_queue.add_queue(agent)
+                for hook in new_queue_hooks:
+                    hook(agent)
+                for seq, item in parked.pop(agent, []):
+                    message_queue.message_queue[agent].restore(seq, item)
+            message_queue.message_queue[agent].watcher = leaf.wakeup
+            owners[agent] = name
+            registered.append(agent)
+        dropped = [agent for agent in leaf.agents if agent not in registered]
+        leaf.agents = registered
+        leaf.aliases = dict((agent, agent_aliases.get(agent, []))
+            for agent in registered)
+        leaf.last_seen = time.time()
+
+        # Agents the leaf doesn't have anymore can't be sent anything, so they
+        # go away entirely.
+        for agent in dropped:
+            _remove_agent(name, agent)
+
+        for other in leaves.values():
+            merged.update(other.aliases)
+        merged.update(aliases)
+        message_queue.build_routes(merged)
+    logging.info("Leaf %s registered agents %s." % (name, registered))
+    return (registered, refused)
+
+# authorized(): Check that something claiming to be a leaf is allowed to
+#   federate with the hub and sent that leaf's shared secret.  The secrets are
+#   compared in constant time so they can't be guessed a character at a time.
+#   Takes two args, the name of the leaf and the secret it sent.  Returns True
+#   or False.
+def authorized(name, secret):
+    if name not in allowed_leaves:
+        return False
+    return hmac.compare_digest(allowed_leaves[name].encode("utf-8"),
+        secret.encode("utf-8"))
+
+# park(): Hold on to a command for an agent that doesn't have a message queue
+#   yet because its leaf hasn't registered since the hub started, so that it
+#   can be put into the queue when it does.  Takes three args, the name of the
+#   agent, the command's sequence number, and the command.
+def park(agent, seq, item):
+    with lock:
+        parked.setdefault(agent, []).append((seq, item))
+    return
+
+# Take an agent that a leaf doesn't have anymore out of the hub: forget who it
+# belonged to, throw away its message queue, and tell the owner about any
+# commands that were still waiting in it.  The caller has to be holding the
+# lock and rebuild the routing index afterward.  Takes two args, the name of
+# the leaf and the name of the agent.
+def _remove_agent(name, agent):
+    queue = message_queue.message_queue.pop(agent, None)
+    entries = []
+
+    owners.pop(agent, None)
+    if not queue:
+        return
+    entries = queue.get_entries(queue.depth())
+    logging.warning("Leaf %s doesn't have agent %s anymore, dropped %d commands that were waiting for it." %
+        (name, agent, len(entries)))
+    if not entries:
+        return
+    try:
+        message_queue.message_queue["replies"].put({"name": name,
+            "reply": "Agent %s isn't on leaf %s anymore, so these commands never got to it:\n%s" %
+            (agent, name, "\n".join(str(entry.item) for entry in entries))})
+    except message_queue.QueueFull:
+        logging.warning("The replies queue is full, so the owner couldn't be told about the dropped commands.")
+    return
+
+# collect(): Lease up to count commands out of the queues of every agent that
+#   belongs to a leaf.  If there aren't any, wait up to timeout seconds for
+#   some to show up.  Takes four args, the name of the leaf, the most
+#   commands to take from any one queue, the timeout, and the length of the
+#   leases in seconds.  Returns a hash table of agent names to lists of (lease
+#   ID, queue entry) tuples (only for agents that had any), or None if the
+#   leaf isn't registered.
+def collect(name, count, timeout=0, duration=lease_time):
+    deadline = time.monotonic() + timeout
+    leaf = leaves.get(name)
+    collected = {}
+    entries = []
+
+    if not leaf:
+        return None
+    while True:
+        leaf.last_seen = time.time()
+
+        # Clear the alarm before looking so that anything added while the
+        # queues are being looked at sets it again.
+        leaf.wakeup.clear()
+        for agent in leaf.agents:
+
+            # The leaf might have registered again without this agent since
+            # the list was looked at.
+            if agent not in message_queue.message_queue:
+                continue
+            entries = message_queue.message_queue[agent].lease(count,
+                duration)
+            if entries:
+                collected[agent] = entries
+        if collected or not leaf.wakeup.wait(max(0.0,
+                deadline - time.monotonic())):
+            return collected
+
+# ack(): Acknowledge the commands a leaf got.  Takes two args, the name of the
+#   leaf and a hash table of agent names to lists of lease IDs.  Returns a
+#   list of the lease IDs that weren't found, because they already ran out (or
+#   the agent isn't the leaf's).
+def ack(name, lease_ids):
+    expired = []
+
+    for agent, ids in lease_ids.items():
+        if owners.get(agent) != name or agent not in message_queue.message_queue:
+            expired.extend(ids)
+            continue
+        for i in ids:
+            if not message_queue.message_queue[agent].ack(i):
+                expired.append(i)
+    return expired
+
+# status(): Return a hash table describing every leaf that's registered.
+def status():
+    with lock:
+        return dict((leaf.name, {"agents": leaf.agents,
+            "last seen": round(time.time() - leaf.last_seen, 1)})
+            for leaf in leaves.values())
+
+# compress(): gzip a JSON document for the link between a hub and a leaf.
+#   Returns bytes.
+def compress(document):
+    return gzip.compress(json.dumps(document).encode("utf-8"))
+
+# Link: The leaf's end of the link to the hub.
+class Link(object):
+
+    # Number of seconds each long-poll for commands waits at the hub.
+    poll_wait = 30
+
+    # Most commands taken out of any one agent's queue at the hub at a time,
+    # and most replies sent to the hub at a time.
+    max_batch = 100
+
+    # Number of seconds to wait before trying again when the hub can't be
+    # reached.
+    retry_interval = 5
+
+    # Initialize new instances of the class.  Takes five args, the URL of the
+    # hub's REST API, the name of this leaf, the secret this leaf shares with
+    # the hub, a list of the agents on this leaf, and a hash table of their
+    # aliases.
+    def __init__(self, hub, name, secret, agents, agent_aliases={}):
+        self.hub = urlsplit(hub)
+        self.name = name
+        self.secret = secret
+        self.agents = agents
+        self.aliases = agent_aliases
+        self.registered = False
+
+    # Open a new HTTP connection to the hub.  Every thread that talks to the
+    # hub has its own, and keeps it open between requests.
+    def _connect(self):
+        if self.hub.scheme == "https":
+            return http.client.HTTPSConnection(self.hub.hostname,
+                self.hub.port, timeout=self.poll_wait + 30)
+        return http.client.HTTPConnection(self.hub.hostname, self.hub.port,
+            timeout=self.poll_wait + 30)
+
+    # Send a request to the hub.  Takes four args, the connection, the HTTP
+    # method, the API rail under /federation/<leaf>, and an optional JSON
+    # document to send.  Returns a tuple of the HTTP status code, the JSON
+    # document that came back (or None), and the response's headers.
+    def _request(self, connection, method, rail, document=None):
+        headers = {"Accept-Encoding": "gzip",
+            "Authorization": "Bearer %s" % self.secret}
+        body = None
+        response = None
+        content = b""
+
+        if document is not None:
+            body = compress(document)
+            headers["Content-Type"] = "application/json"
+            headers["Content-Encoding"] = "gzip"
+        connection.request(method, "%s/federation/%s%s" %
+            (self.hub.path.rstrip("/"), self.name, rail), body=body,
+            headers=headers)
+        response = connection.getresponse()
+        content = response.read()
+        if response.getheader("Content-Encoding") == "gzip":
+            content = gzip.decompress(content)
+        if not content:
+            return (response.status, None, response)
+        return (response.status, json.loads(content.decode("utf-8")),
+            response)
+
+    # Register this leaf's agents with the hub.
+    def register(self, connection):
+        status = 0
+        document = None
+
+        status, document, response = self._request(connection, "PUT", "",
+            {"agents": self.agents, "aliases": self.aliases})
+        if status != 200:
+            raise http.client.HTTPException("the hub refused to register this leaf (%d): %s" %
+                (status, document))
+        if document["refused"]:
+            logging.warning("The hub refused agents %s, which belong to somebody else." %
+                document["refused"])
+        logging.info("Registered agents %s with the hub." %
+            document["registered"])
+        self.registered = True
+        return
+
+    # Start sending replies to the hub, then fetch commands from the hub
+    # until the bridge shuts down.
+    def run(self):
+        threading.Thread(target=self._send_replies, name="federation replies",
+            daemon=True).start()
+        self._fetch_commands()
+        return
+
+    # Long-poll the hub for commands and put them into the agents' message
+    # queues.  Commands keep the trace IDs the hub gave them, so a bot that
+    # sends the trace ID back lets the hub follow the whole round trip.
+    def _fetch_commands(self):
+        connection = None
+        status = 0
+        document = None
+        commands = []
+        traces = []
+        acknowledged = {}
+
+        while True:
+            try:
+                if not connection:
+                    connection = self._connect()
+                if not self.registered:
+                    self.register(connection)
+
+                status, document, response = self._request(connection, "GET",
+                    "?wait=%d&max=%d&lease=%d" % (self.poll_wait,
+                    self.max_batch, lease_time))
+                if status == 404:
+                    logging.info("The hub forgot about this leaf, registering again.")
+                    self.registered = False
+                    continue
+                if status != 200:
+                    raise http.client.HTTPException("the hub sent back a %d: %s" %
+                        (status, document))
+
+                acknowledged = {}
+                for agent, batch in document["commands"].items():
+                    commands = batch["commands"]
+                    traces = batch.get("traces") or [None] * len(commands)
+                    logging.debug("Got %d commands for agent %s from the hub." %
+                        (len(commands), agent))
+                    for command, trace, lease_id in zip(commands, traces,
+                            batch["ids"]):
+                        if self._put_command(agent, command, trace):
+                            acknowledged.setdefault(agent, []).append(lease_id)
+                if acknowledged:
+                    self._acknowledge(connection, acknowledged)
+            except (OSError, ValueError, KeyError,
+                    http.client.HTTPException) as e:
+                logging.warning("Unable to get commands from the hub %s: %s.  Trying again in %d seconds." %
+                    (self.hub.geturl(), e, self.retry_interval))
+                if connection:
+                    connection.close()
+                connection = None
+                self.registered = False
+                time.sleep(self.retry_interval)
+
+    # Tell the hub which commands made it into this leaf's queues, so it
+    # doesn't send them again.  Takes two args, the connection and a hash
+    # table of agent names to lists of lease IDs.
+    def _acknowledge(self, connection, acknowledged):
+        status = 0
+        document = None
+
+        status, document, response = self._request(connection, "PUT", "/ack",
+            acknowledged)
+
+        # Leases that ran out before they were acknowledged are going to be
+        # sent again, and there's nothing to do about it but put up with it.
+        if status == 404:
+            logging.warning("Leases %s ran out before they could be acknowledged, so the hub will send those commands again." %
+                document["not found"])
+            return
+        if status != 200:
+            raise http.client.HTTPException("the hub sent back a %d: %s" %
+                (status, document))
+        return
+
+    # Put a command from the hub into an agent's message queue.  Returns True
+    # if the hub doesn't have to send it again.
+    def _put_command(self, agent, command, trace):
+        if agent not in message_queue.message_queue:
+            logging.warning("The hub sent a command for agent %s, which doesn't live here: %s" %
+                (agent, command))
+            self._report("Leaf %s doesn't have an agent named %s, so it couldn't run this command: %s" %
+                (self.name, agent, command))
+            return True
+        try:
+            message_queue.message_queue[agent].put(command, trace)
+        except message_queue.QueueFull:
+            logging.warning("Agent %s's queue is full, the hub will send this command again in %d seconds: %s" %
+                (agent, lease_time, command))
+            return False
+        return True
+
+    # Send the owner a message about something that went wrong on this leaf,
+    # through the hub.  Takes one arg, the message.
+    def _report(self, message):
+        try:
+            message_queue.message_queue["replies"].put({"name": self.name,
+                "reply": message})
+        except message_queue.QueueFull:
+            logging.warning("The replies queue is full, so this couldn't be sent to the owner: %s" %
+                message)
+        return
+
+    # Send the replies that this leaf's bots PUT to /replies to the hub, a
+    # batch at a time.  A batch is held on to until the hub takes it.
+    def _send_replies(self):
+        replies = message_queue.message_queue["replies"]
+        connection = None
+        batch = []
+        status = 0
+        document = None
+        delay = 0.0
+
+        while True:
+            if not batch:
+                batch = replies.get_many(self.max_batch, self.poll_wait)
+                continue
+            try:
+                if not connection:
+                    connection = self._connect()
+                status, document, response = self._request(connection, "PUT",
+                    "/replies", batch)
+                if status == 200:
+                    logging.debug("Sent %d replies to the hub." % len(batch))
+                    batch = []
+                    continue
+
+                # The hub's replies queue is full, so back off for as long
+                # as it says to.
+                if status == 429:
+                    delay = float(response.getheader("Retry-After",
+                        self.retry_interval))
+                    logging.warning("The hub's replies queue is full, trying again in %d seconds." %
+                        delay)
+                    time.sleep(delay)
+                    continue
+
+                # If the hub didn't like the replies, sending them again
+                # won't help.
+                if status == 400:
+                    logging.error("The hub refused %d replies: %s" %
+                        (len(batch), document))
+                    batch = []
+                    continue
+                raise http.client.HTTPException("the hub sent back a %d: %s" %
+                    (status, document))
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                logging.warning("Unable to send %d replies to the hub %s: %s.  Trying again in %d seconds." %
+                    (len(batch), self.hub.geturl(), e, self.retry_interval))
+                if connection:
+                    connection.close()
+                connection = None
+                time.sleep(self.retry_interval)
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# journal.py - A module of the Exocortex XMPP Bridge that keeps a journal of
+#   everything that goes into and comes out of the message queues in a SQLite
+#   database, so that if the bridge crashes or gets shut down the commands and
+#   replies that were waiting aren't lost.
+#
+#   The journal is append-only: every item added to a queue gets a row in the
+#   "entries" table, and every item taken out of a queue gets a row in the
+#   "acks" table.  Anything in "entries" that doesn't have a matching row in
+#   "acks" was still waiting when the bridge went down and gets put back into
+#   its queue when the bridge starts up.  Writes are batched up and committed
+#   every so often (group commit) by a separate thread, so adding something to
+#   a queue doesn't have to wait for the disk.  Every once in a while the
+#   acknowledged entries are deleted to keep the database from growing
+#   forever.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+# Journal: The message queue journal.  record_put() and record_ack() are
+#   called by the message queues and just add the change to a list in memory;
+#   a background thread started by start() writes them to the database.
+class Journal(object):
+
+    # Initialize new instances of the class.  Takes three args, the path to the
+    # database file, how often (in seconds) to commit changes to the
+    # database, and how often (in seconds) to clean acknowledged entries out of
+    # the database.
+    def __init__(self, path, commit_interval=0.05, compact_interval=300):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_interval = compact_interval
+
+        # Changes that haven't been written to the database yet.
+        self.pending_puts = []
+        self.pending_acks = []
+        self.lock = threading.Lock()
+
+        # Set when it's time for the writer thread to shut down.
+        self.stopping = threading.Event()
+        self.writer = None
+
+        # Handle to the database.  After start() is called, only the writer
+        # thread touches it.
+        self.database = sqlite3.connect(path, check_same_thread=False)
+        self.database.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.database.execute("PRAGMA journal_mode = WAL")
+        self.database.execute("PRAGMA synchronous = FULL")
+        self.database.execute("CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, queue TEXT NOT NULL, item TEXT NOT NULL)")
+        self.database.execute("CREATE TABLE IF NOT EXISTS acks (id INTEGER PRIMARY KEY)")
+        self.database.commit()
+
+    # Note that an item was added to a message queue.  Takes three args, the
+    # name of the queue, the item's sequence number, and the item serialized
+    # as JSON.
+    def record_put(self, queue, seq, item):
+        with self.lock:
+            self.pending_puts.append((seq, queue, item))
+        return
+
+    # Note that an item was taken out of a message queue.  Takes one arg, the
+    # item's sequence number.
+    def record_ack(self, seq):
+        with self.lock:
+            self.pending_acks.append((seq,))
+        return
+
+    # Read everything out of the journal that was never acknowledged.  Call
+    # this before start().  Returns a list of (sequence number, queue name,
+    # JSON) tuples in the order they were originally added, and the highest
+    # sequence number in the journal (or 0 if it's empty).
+    def replay(self):
+        cursor = None
+        entries = []
+        highest = 0
+
+        cursor = self.database.execute("SELECT id, queue, item FROM entries WHERE id NOT IN (SELECT id FROM acks) ORDER BY id")
+        entries = cursor.fetchall()
+        cursor = self.database.execute("SELECT MAX(id) FROM entries")
+        highest = cursor.fetchone()[0] or 0
+        logging.info("Found %d unacknowledged entries in the journal %s." %
+            (len(entries), self.path))
+        return (entries, highest)
+
+    # Start the thread that writes to the database.
+    def start(self):
+        self.writer = threading.Thread(target=self._write_loop,
+            name="journal", daemon=True)
+        self.writer.start()
+        return
+
+    # Write anything that's pending to the database and shut down the writer
+    # thread.
+    def stop(self):
+        self.stopping.set()
+        if self.writer:
+            self.writer.join()
+        self.flush()
+        self.database.close()
+        return
+
+    # Write all of the pending changes to the database in a single
+    # transaction.  Returns the number of changes written.
+    def flush(self):
+        puts = []
+        acks = []
+
+        with self.lock:
+            puts = self.pending_puts
+            acks = self.pending_acks
+            self.pending_puts = []
+            self.pending_acks = []
+        if not puts and not acks:
+            return 0
+
+        with self.database:
+            self.database.executemany("INSERT OR REPLACE INTO entries (id, queue, item) VALUES (?, ?, ?)", puts)
+            self.database.executemany("INSERT OR IGNORE INTO acks (id) VALUES (?)", acks)
+        return len(puts) + len(acks)
+
+    # Throw away every entry that's been acknowledged, then shrink the
+    # database and its write-ahead log.
+    def compact(self):
+        removed = 0
+
+        with self.database:
+            removed = self.database.execute("DELETE FROM entries WHERE id IN (SELECT id FROM acks)").rowcount
+            self.database.execute("DELETE FROM acks")
+        self.database.execute("PRAGMA incremental_vacuum")
+        self.database.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logging.debug("Compacted the journal, removed %d entries." % removed)
+        return
+
+    # The writer thread.  Commits pending changes every commit_interval
+    # seconds and compacts the database every compact_interval seconds.
+    def _write_loop(self):
+        last_compaction = time.monotonic()
+
+        while not self.stopping.wait(self.commit_interval):
+            try:
+                self.flush()
+                if time.monotonic() - last_compaction >= self.compact_interval:
+                    self.compact()
+                    last_compaction = time.monotonic()
+            except sqlite3.Error as e:
+                logging.error("Unable to write to the journal %s: %s" %
+                    (self.path, e))
+        return
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
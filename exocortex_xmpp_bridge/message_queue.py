@@ -8,6 +8,50 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v5.15 - AgentQueue.watcher, a threading.Event that's set whenever something
+#        is added to the queue, so one thread can wait on several queues at
+#        once (see federation.py).
+# v5.14 - AgentQueue.peek() can start partway into the queue, for paging
+#        through it.
+# v5.13 - Added a routing index that maps agent names as the user might type
+#        them (any capitalization, an alias, or off by one letter) to the
+#        names of their message queues with a single lookup.
+# v5.12 - Added priority lanes.  Every message queue has a high, a normal,
+#        and a low priority lane, and commands are sorted into them by their
+#        first word.  Higher lanes are served first, but anything that's been
+#        waiting long enough gets bumped up so it can't be starved.
+# v5.11 - Message queues can be limited to a number of items and a number
+#        of bytes.  When a queue is full, new items are refused with a
+#        QueueFull exception or (if the queue's policy is "drop_oldest") the
+#        oldest items are thrown away to make room.  Both are counted.
+# v5.10 - Entries can carry a trace ID, and taking one out of a queue marks
+#        the trace as dequeued.  Added AgentQueue.get_entries() for callers
+#        that need the whole entry, and AgentQueue.lease() returns entries
+#        too.
+# v5.9 - Every queue keeps a histogram of how long items wait in it, and
+#        AgentQueue.stats() reports its depth, oldest item, and counters, for
+#        the /metrics rail.
+# v5.8 - Added AgentQueue.get_streamed() and AgentQueue.streamed_since() for
+#        sending commands to bots over streaming connections.
+# v5.7 - Added leases.  AgentQueue.lease() hands out items with a lease ID and
+#        a time limit; AgentQueue.ack() finishes them off.  Leases that run
+#        out put their items back at the front of the queue.
+# v5.6 - Every entry gets a sequence number.  If a journal is set up,
+#        everything that goes into or comes out of a queue is written to it,
+#        and AgentQueue.restore() puts entries read back out of the journal
+#        into their queues on startup.
+# v5.5 - Added AgentQueue.peek().
+# v5.4 - Added AgentQueue.put_many().
+# v5.3 - Added AgentQueue.get_many() so that a bot can drain a bunch of
+#        commands at once.
+# v5.2 - Replaced the lists with AgentQueue objects: deques guarded by a
+#        condition variable, so adding and removing items is O(1) and the
+#        REST API's threads and SliXMPP's event loop can't trip over each
+#        other.  They also keep track of their depth and the age of the
+#        oldest item.
+# v5.1 - Added a condition variable and a couple of helper functions so that
+#        the REST API can park long-polling requests until a command shows up
+#        in an agent's message queue instead of making bots hammer it.
 # v5.0 - Reworking for Python 3.
 # v4.0 - Refacted bot to break major functional parts out into separate modules.
 # v3.0 - Rewriting to use SleekXMPP, because I'm tired of XMPPpy's lack of
@@ -53,12 +97,630 @@
 
 # License: GPLv3
 
+from collections import deque
+
+import heapq
+import itertools
+import json
+import logging
+import string
+import sys
+import threading
+import time
+
+import metrics
+import tracing
+
+# Sequence numbers for queue entries.  They're unique across every queue so
+# that an entry can be found in the journal later.
+sequence = itertools.count(1)
+
+# Handle to a journal.Journal object, if the message queues are being
+# persisted.
+journal = None
+
+# What a full message queue can do when something new is added to it:
+# refuse the new item, or throw away the oldest items to make room.
+policies = ["reject", "drop_oldest"]
+
+# Priority levels, most urgent first.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# QueueFull: Raised when something is added to a message queue that's already
+#   full (or when the new item is bigger than the queue can ever hold).
+class QueueFull(Exception):
+    pass
+
+# Number of entries sent over streaming connections that each message queue
+# remembers so that they can be sent again if the connection drops.
+history_length = 100
+
+# Entry: A single item in a message queue, along with its sequence number,
+#   the time it was added to the queue so that the age of the backlog can be
+#   figured out, and its trace ID (if it's being traced).
+class Entry(object):
+    __slots__ = ["item", "seq", "enqueued", "trace", "size", "priority"]
+
+    def __init__(self, item, seq=None, trace=None, priority=NORMAL):
+        self.item = item
+        if seq is None:
+            seq = next(sequence)
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.trace = trace
+        self.priority = priority
+
+        # Roughly how much memory the item takes up, for limiting queues by
+        # size.
+        if isinstance(item, str):
+            self.size = len(item.encode("utf-8"))
+        else:
+            self.size = len(json.dumps(item))
+
+# Lanes: The insides of a message queue, one FIFO deque per priority level.
+#   Acts enough like a deque that AgentQueue doesn't have to care.  popleft()
+#   takes the earliest entry from the most urgent lane that has anything in
+#   it, except that an entry moves up one level for every aging seconds it's
+#   been waiting, so a pile of urgent commands can't keep a low priority one
+#   waiting forever.  Only the entry at the front of each lane has to be
+#   looked at, so that's still O(1).
+class Lanes(object):
+
+    # Initialize new instances of the class.  Takes one arg, the number of
+    # seconds an entry has to wait to move up a level (0 to never move
+    # entries up).
+    def __init__(self, aging=30):
+        self.lanes = [deque() for i in (HIGH, NORMAL, LOW)]
+        self.aging = aging
+        self.length = 0
+
+    # Add an entry to the end of its lane.
+    def append(self, entry):
+        self.lanes[entry.priority].append(entry)
+        self.length += 1
+        return
+
+    # Put an entry back at the front of its lane.
+    def appendleft(self, entry):
+        self.lanes[entry.priority].appendleft(entry)
+        self.length += 1
+        return
+
+    # Remove and return the entry that should be served next.
+    def popleft(self):
+        self.length -= 1
+        return self._next_lane().popleft()
+
+    # Remove and return the entry that was added first, regardless of
+    # priority.
+    def pop_oldest(self):
+        self.length -= 1
+        return min((lane for lane in self.lanes if lane),
+            key=lambda lane: lane[0].seq).popleft()
+
+    # Return the entry that was added first, regardless of priority.
+    def oldest(self):
+        return min((lane[0] for lane in self.lanes if lane),
+            key=lambda entry: entry.seq)
+
+    # Return the lane the next entry should come out of.
+    def _next_lane(self):
+        now = time.monotonic()
+        best = None
+        best_rank = None
+        rank = None
+
+        for level, lane in enumerate(self.lanes):
+            if not lane:
+                continue
+            rank = level
+            if self.aging:
+                rank -= int((now - lane[0].enqueued) / self.aging)
+            if best is None or (rank, lane[0].seq) < best_rank:
+                best = lane
+                best_rank = (rank, lane[0].seq)
+        return best
+
+    # Entries from the most urgent lane to the least, in order within each
+    # lane.
+    def __iter__(self):
+        return itertools.chain(*self.lanes)
+
+    def __len__(self):
+        return self.length
+
+# AgentQueue: A thread-safe FIFO message queue.  The REST API server's
+#   threads and SliXMPP's event loop both touch the message queues, so every
+#   access goes through a condition variable.  Adding and removing items are
+#   O(1) because the queue is a deque and not a list.  Also keeps a couple of
+#   counters so the queue's activity can be reported on.
+#
+#   Items can also be leased out of the queue instead of being removed
+#   outright.  A leased item is held aside until whoever leased it
+#   acknowledges it with ack(); if that doesn't happen before the lease runs
+#   out, the item goes back to the front of the queue for somebody else to
+#   pick up.  This lets more than one copy of a bot work on the same queue
+#   without losing commands if one of them crashes.
+#
+#   Commands whose first word is one of the queue's high priority keywords
+#   (like "help" or "status") go ahead of everything else, and ones whose
+#   first word is a low priority keyword go behind.
+class AgentQueue(object):
+
+    # Initialize new instances of the class.  Takes one argument, the name of
+    # the queue (which is usually the name of the agent that polls it).
+    def __init__(self, name):
+        self.name = name
+        self.queue = Lanes()
+
+        # Keywords that put a command in the high or low priority lane.
+        self.high_priority = set()
+        self.low_priority = set()
+        self.condition = threading.Condition()
+
+        # Running totals of everything that's gone into and come out of the
+        # queue.
+        self.enqueued = 0
+        self.dequeued = 0
+
+        # Limits on how many items and how many bytes of them can be waiting
+        # in the queue (0 means no limit), what happens when it's full, and
+        # the running total of bytes in the queue.
+        self.max_length = 0
+        self.max_bytes = 0
+        self.policy = "reject"
+        self.bytes = 0
+
+        # Number of items refused because the queue was full, and number of
+        # items thrown away to make room for new ones.
+        self.rejected = 0
+        self.dropped = 0
+
+        # How long items waited in the queue before they were taken out.
+        # Only touched while holding the condition variable.
+        self.wait_time = metrics.Histogram()
+
+        # Leased entries, keyed by lease ID.  The values are tuples of the
+        # time the lease runs out and the entry.  lease_expiries is a heap of
+        # (expiration time, lease ID) tuples so that expired leases can be found
+        # without looking at all of them.
+        self.leases = {}
+        self.lease_expiries = []
+
+        # The most recent entries sent to bots over streaming connections, so
+        # that anything that got lost when a connection dropped can be sent
+        # again when the bot reconnects.
+        self.streamed = deque(maxlen=history_length)
+
+        # ID of the newest streaming connection.  Only one streaming
+        # connection per queue is serviced at a time; when a bot reconnects,
+        # the old connection (which is probably dead) gets bumped.
+        self.stream = 0
+
+        # threading.Event that's set every time something is added to the
+        # queue, for anything that needs to wait on more than one queue at a
+        # time.  None if nothing does.
+        self.watcher = None
+
+    # Set the limits on the queue.  Takes three args, the maximum number of
+    # items, the maximum number of bytes (0 for no limit on either), and what
+    # to do when the queue is full (one of policies).
+    def set_limits(self, max_length=0, max_bytes=0, policy="reject"):
+        if policy not in policies:
+            raise ValueError("Unknown queue policy %s." % policy)
+        with self.condition:
+            self.max_length = max_length
+            self.max_bytes = max_bytes
+            self.policy = policy
+        return
+
+    # Set up the queue's priority lanes.  Takes three args, lists of the
+    # keywords that make a command high or low priority, and the number of
+    # seconds a command has to wait to move up a level (0 to never move
+    # commands up).
+    def set_priorities(self, high=[], low=[], aging=30):
+        with self.condition:
+            self.high_priority = set(word.lower() for word in high)
+            self.low_priority = set(word.lower() for word in low)
+            self.queue.aging = aging
+        return
+
+    # Figure out which priority lane an item goes in from its first word.
+    def priority(self, item):
+        word = ""
+
+        if not isinstance(item, str) or not (self.high_priority or
+                self.low_priority):
+            return NORMAL
+        word = item.split(None, 1)[0] if item.strip() else ""
+        word = word.strip(string.punctuation).lower()
+        if word in self.high_priority:
+            return HIGH
+        if word in self.low_priority:
+            return LOW
+        return NORMAL
+
+    # Add an item to the end of the queue and wake up anything that's waiting
+    # on it.  Takes an optional trace ID for the item.  Raises QueueFull if
+    # there's no room for it.
+    def put(self, item, trace=None):
+        entry = Entry(item, trace=trace, priority=self.priority(item))
+
+        with self.condition:
+            self._make_room([entry])
+            self._append(entry)
+            self.condition.notify()
+        if trace:
+            tracing.mark(trace, "enqueued")
+        return
+
+    # Add a list of items to the end of the queue, in order, all at once.
+    # Raises QueueFull if there's no room for all of them, in which case none
+    # of them are added.
+    def put_many(self, items):
+        entries = [Entry(item, priority=self.priority(item)) for item in items]
+
+        with self.condition:
+            self._make_room(entries)
+            for entry in entries:
+                self._append(entry)
+            self.condition.notify(len(entries))
+        return
+
+    # Put an item that was read back out of the journal into the queue.  Takes
+    # two args, the item's original sequence number and the item.  It's
+    # already in the journal so it isn't written there again.
+    def restore(self, seq, item):
+        with self.condition:
+            entry = Entry(item, seq, priority=self.priority(item))
+            self.queue.append(entry)
+            self.enqueued += 1
+            self.bytes += entry.size
+            self.condition.notify()
+        return
+
+    # Remove the earliest item from the queue and return it.  If the queue is
+    # empty, wait for up to timeout seconds for something to show up.
+    # Returns None if nothing did.
+    def get(self, timeout=0):
+        with self.condition:
+            if not self._wait(timeout):
+                return None
+            return self._pop().item
+
+    # Remove up to count of the earliest items from the queue in one go and
+    # return them as a list.  If the queue is empty, wait for up to timeout
+    # seconds for something to show up.  Returns an empty list if nothing did.
+    def get_many(self, count, timeout=0):
+        return [entry.item for entry in self.get_entries(count, timeout)]
+
+    # Same as get_many(), only it returns the entries themselves instead of
+    # just the items.
+    def get_entries(self, count, timeout=0):
+        entries = []
+
+        with self.condition:
+            self._wait(timeout)
+            while self.queue and len(entries) < count:
+                entries.append(self._pop())
+        return entries
+
+    # Register a new streaming connection, which bumps whatever streaming
+    # connection was already open.  Returns the new connection's ID.
+    def open_stream(self):
+        with self.condition:
+            self.stream = next(sequence)
+            self.condition.notify_all()
+            return self.stream
+
+    # Remove the earliest entry from the queue for sending over a streaming
+    # connection and return it.  The entry is remembered for a while in case
+    # the connection drops before it gets there.  Takes two args, the
+    # connection's ID and the number of seconds to wait for something to show
+    # up if the queue is empty.  Returns None if nothing did, or if the
+    # connection was bumped by a newer one.
+    def get_streamed(self, stream, timeout=0):
+        entry = None
+
+        with self.condition:
+            if not self._wait(timeout, lambda: self.stream != stream):
+                return None
+            entry = self._pop()
+            self.streamed.append(entry)
+        return entry
+
+    # Return every remembered entry that was sent over a streaming connection
+    # after the one with sequence number seq, in order.
+    def streamed_since(self, seq):
+        with self.condition:
+            return [entry for entry in self.streamed if entry.seq > seq]
+
+    # Lease up to count of the earliest items out of the queue for duration
+    # seconds.  If the queue is empty, wait for up to timeout seconds for
+    # something to show up.  Returns a list of (lease ID, entry) tuples, which
+    # is empty if nothing showed up.
+    def lease(self, count, duration, timeout=0):
+        leased = []
+        entry = None
+        lease_id = 0
+        expires = 0.0
+
+        with self.condition:
+            self._wait(timeout)
+            expires = time.monotonic() + duration
+            while self.queue and len(leased) < count:
+                entry = self._pop(ack=False)
+                lease_id = next(sequence)
+                self.leases[lease_id] = (expires, entry)
+                heapq.heappush(self.lease_expiries, (expires, lease_id))
+                leased.append((lease_id, entry))
+        return leased
+
+    # Acknowledge a leased item, which means that it's been taken care of and
+    # can be forgotten about.  Takes one arg, the lease ID.  Returns True if
+    # the lease was found, False if it wasn't (because it already ran out or
+    # never existed).
+    def ack(self, lease_id):
+        entry = None
+
+        with self.condition:
+            self._expire_leases()
+            if lease_id not in self.leases:
+                return False
+            entry = self.leases.pop(lease_id)[1]
+            if journal:
+                journal.record_ack(entry.seq)
+        return True
+
+    # Wait for up to timeout seconds for there to be something in the queue,
+    # putting expired leases back along the way.  If abort is given, it's
+    # called every time the caller wakes up and the wait ends early if it
+    # returns True.  The caller has to be holding the condition variable.
+    # Returns True if there's something in the queue.
+    def _wait(self, timeout, abort=None):
+        deadline = time.monotonic() + timeout
+        remaining = 0.0
+
+        while True:
+            if abort and abort():
+                return False
+            self._expire_leases()
+            if self.queue:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            # Wake up in time to put back the next lease that runs out.
+            if self.lease_expiries:
+                remaining = min(remaining,
+                    max(0.0, self.lease_expiries[0][0] - time.monotonic()))
+            self.condition.wait(remaining)
+
+    # Put every leased entry whose lease has run out back at the front of the
+    # queue, in the order they were originally added.  The caller has to be
+    # holding the condition variable.
+    def _expire_leases(self):
+        now = time.monotonic()
+        expired = []
+        lease_id = 0
+
+        while self.lease_expiries and self.lease_expiries[0][0] <= now:
+            lease_id = heapq.heappop(self.lease_expiries)[1]
+            if lease_id in self.leases:
+                expired.append(self.leases.pop(lease_id)[1])
+        if not expired:
+            return
+
+        expired.sort(key=lambda entry: entry.seq, reverse=True)
+        for entry in expired:
+            self.queue.appendleft(entry)
+            self.dequeued -= 1
+            self.bytes += entry.size
+        self.condition.notify(len(expired))
+        return
+
+    # Make sure there's room in the queue for a list of new entries, throwing
+    # away the oldest entries if the queue's policy allows it.  Raises
+    # QueueFull if there isn't room.  The caller has to be holding the
+    # condition variable.
+    def _make_room(self, entries):
+        length = len(self.queue) + len(entries)
+        size = self.bytes + sum(entry.size for entry in entries)
+        entry = None
+
+        if self.policy == "drop_oldest" and (not self.max_length or
+                len(entries) <= self.max_length) and (not self.max_bytes or
+                size - self.bytes <= self.max_bytes):
+            while self.queue and ((self.max_length and
+                    length > self.max_length) or (self.max_bytes and
+                    size > self.max_bytes)):
+                entry = self.queue.pop_oldest()
+                self.bytes -= entry.size
+                self.dropped += 1
+                if journal:
+                    journal.record_ack(entry.seq)
+                length -= 1
+                size -= entry.size
+
+        if (self.max_length and length > self.max_length) or \
+                (self.max_bytes and size > self.max_bytes):
+            self.rejected += len(entries)
+            raise QueueFull("Message queue %s is full." % self.name)
+        return
+
+    # Add an entry to the end of the queue and write it to the journal.  The
+    # caller has to be holding the condition variable.
+    def _append(self, entry):
+        self.queue.append(entry)
+        self.enqueued += 1
+        self.bytes += entry.size
+        if journal:
+            journal.record_put(self.name, entry.seq, json.dumps(entry.item))
+        if self.watcher:
+            self.watcher.set()
+        return
+
+    # Remove the earliest entry from the queue, mark it as done in the
+    # journal (unless it's being leased), and return it.  The caller has to be
+    # holding the condition variable and make sure the queue isn't empty.
+    def _pop(self, ack=True):
+        entry = self.queue.popleft()
+        self.dequeued += 1
+        self.bytes -= entry.size
+        self.wait_time.record(time.monotonic() - entry.enqueued)
+        if journal and ack:
+            journal.record_ack(entry.seq)
+        if entry.trace:
+            tracing.mark(entry.trace, "dequeued")
+        return entry
+
+    # Return up to count of the earliest entries in the queue (items and the
+    # times they were added), most urgent first, without removing them.  If
+    # start is given, skip that many entries first.
+    def peek(self, count=1, start=0):
+        with self.condition:
+            return list(itertools.islice(self.queue, start, start + count))
+
+    # Return the number of items in the queue.
+    def depth(self):
+        if self.leases:
+            with self.condition:
+                self._expire_leases()
+        return len(self.queue)
+
+    # Return the number of items that are leased out right now.
+    def leased(self):
+        return len(self.leases)
+
+    def __len__(self):
+        return len(self.queue)
+
+    # Return the age in seconds of the earliest item in the queue, or 0.0 if
+    # the queue is empty.
+    def oldest_age(self):
+        with self.condition:
+            if not self.queue:
+                return 0.0
+            return time.monotonic() - self.queue.oldest().enqueued
+
+    # Return the queue's depth (in items and bytes), the age of its oldest
+    # item, the number of items leased out of it, and its counters as a hash
+    # table.
+    def stats(self):
+        with self.condition:
+            self._expire_leases()
+            return { "depth": len(self.queue),
+                "bytes": self.bytes,
+                "oldest age": (time.monotonic() - self.queue.oldest().enqueued) if self.queue else 0.0,
+                "leased": len(self.leases),
+                "enqueued": self.enqueued,
+                "dequeued": self.dequeued,
+                "rejected": self.rejected,
+                "dropped": self.dropped }
+
+    # Return a copy of the items in the queue, most urgent first.
+    def items(self):
+        with self.condition:
+            return [entry.item for entry in self.queue]
+
 # This hash table's keys are the names of agents, the associated values are
-# lists which implement the message queues.
+# AgentQueue objects which implement the message queues.
 message_queue = {}
 
+# add_queue(): Create a message queue.  Takes one argument, the name of the
+#   queue.  Returns the new queue.
+def add_queue(name):
+    message_queue[name] = AgentQueue(name)
+    return message_queue[name]
+
 # Add the message queue so this bot's agents can send replies.
-message_queue['replies'] = []
+add_queue("replies")
+
+# The routing index.  Keys are names the user might call an agent by, values
+# are the names of the agents' message queues.  Built by build_routes().
+routes = {}
+
+# Characters that might be fat-fingered into or out of an agent's name.
+typo_characters = string.ascii_lowercase + string.digits + "-_"
+
+# Agent names shorter than this aren't matched with typos because too many
+# other words would be one letter off from them.
+min_typo_length = 4
+
+# typos(): Return every string one insertion, deletion, substitution, or
+#   transposition of adjacent letters away from a name.
+def typos(name):
+    variants = set()
+
+    for i in range(len(name) + 1):
+        for c in typo_characters:
+            variants.add(name[:i] + c + name[i:])
+        if i < len(name):
+            variants.add(name[:i] + name[i + 1:])
+            for c in typo_characters:
+                variants.add(name[:i] + c + name[i + 1:])
+        if i < len(name) - 1:
+            variants.add(name[:i] + name[i + 1] + name[i] + name[i + 2:])
+    variants.discard(name)
+    return variants
+
+# build_routes(): Build the routing index for every message queue except the
+#   replies queue.  Takes one optional arg, a hash table of agent names to
+#   lists of aliases.  Names are matched exactly, then without regard to case,
+#   then by alias, then with one typo.  If an alias or a typo could mean more
+#   than one agent it's left out.
+def build_routes(aliases={}):
+    global routes
+    exact = {}
+    ambiguous = set()
+    variants = {}
+    key = ""
+
+    # Exact names, names in lowercase, and aliases.
+    for name in message_queue:
+        if name == "replies":
+            continue
+        exact[name] = name
+    for name in list(exact.keys()):
+        for key in [name.casefold()] + [i.casefold() for i in aliases.get(name, [])]:
+            if key in exact and exact[key] != name:
+                if key not in message_queue:
+                    logging.warning("%s could mean agent %s or agent %s, ignoring it." %
+                        (key, exact[key], name))
+                    ambiguous.add(key)
+                continue
+            exact[key] = name
+    for key in ambiguous:
+        exact.pop(key, None)
+
+    # One typo away from the name of an agent (in lowercase).
+    ambiguous = set()
+    for name in message_queue:
+        if name == "replies" or len(name) < min_typo_length:
+            continue
+        for key in typos(name.casefold()):
+            if key in variants and variants[key] != name:
+                ambiguous.add(key)
+            variants[key] = name
+    for key in ambiguous:
+        variants.pop(key)
+    variants.update(exact)
+
+    routes = variants
+    logging.debug("Built a routing index with %d entries for %d agents." %
+        (len(routes), len(exact)))
+    return
+
+# resolve(): Figure out which agent a name the user typed means.  Takes one
+#   arg, the name.  Returns the name of the agent's message queue, or None if
+#   it doesn't match anything.
+def resolve(name):
+    if name in routes:
+        return routes[name]
+    return routes.get(name.casefold())
 
 if "__name__" == "__main__":
     print("No self tests yet.")
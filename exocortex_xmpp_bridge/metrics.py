@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# metrics.py - A module of the Exocortex XMPP Bridge that keeps track of how
+#   the bridge is performing: how deep the message queues are, how long things
+#   sit in them, how long replies take to go out over XMPP, and how many
+#   requests the REST API has handled.  The REST API's /metrics rail turns all
+#   of this into either Prometheus' text format or JSON.
+#
+#   Recording something has to be cheap because it happens on every poll, so
+#   latencies go into histograms with fixed buckets (log-linear, in the style
+#   of HdrHistogram) instead of being kept around individually.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import math
+import sys
+import threading
+
+# Histogram: Latency histogram.  Bucket boundaries grow exponentially from
+#   lowest to highest with sub_buckets buckets per doubling, so the relative
+#   error is about the same whether something took a millisecond or an hour,
+#   and recording a value is O(1).  The counts are a fixed-size list, so they
+#   can be read from another thread without locking (at worst the reader sees
+#   a value that's one sample out of date).
+class Histogram(object):
+
+    # Initialize new instances of the class.  Takes three args, the smallest
+    # and largest values (in seconds) worth telling apart, and the number of
+    # buckets per doubling.
+    def __init__(self, lowest=0.001, highest=3600.0, sub_buckets=2):
+        self.lowest = lowest
+        self.sub_buckets = sub_buckets
+
+        # The upper bound of every bucket.  Anything bigger than the last one
+        # goes into an overflow bucket at the end of counts.
+        self.bounds = []
+        i = 0
+        while not self.bounds or self.bounds[-1] < highest:
+            self.bounds.append(lowest * (2 ** (i / float(sub_buckets))))
+            i += 1
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    # Add a value (in seconds) to the histogram.
+    def record(self, value):
+        index = 0
+
+        if value > self.lowest:
+            index = math.ceil(math.log2(value / self.lowest) *
+                self.sub_buckets)
+            if index > len(self.bounds):
+                index = len(self.bounds)
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+        return
+
+    # Estimate the value at a given quantile (between 0.0 and 1.0), which is
+    # the upper bound of the bucket it falls into.  Anything in the overflow
+    # bucket is reported as the largest bound.  Returns 0.0 if the histogram is
+    # empty.
+    def quantile(self, q):
+        counts = list(self.counts)
+        target = q * sum(counts)
+        running = 0
+
+        if not target:
+            return 0.0
+        for i, count in enumerate(counts):
+            running += count
+            if running >= target:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    # Return a list of (upper bound, cumulative count) tuples, the way
+    # Prometheus wants histogram buckets.  The last bound is +Inf.
+    def cumulative(self):
+        counts = list(self.counts)
+        buckets = []
+        running = 0
+
+        for i, count in enumerate(counts):
+            running += count
+            if i < len(self.bounds):
+                buckets.append((self.bounds[i], running))
+            else:
+                buckets.append((float("inf"), running))
+        return buckets
+
+    # Return a summary of the histogram as a hash table.
+    def summary(self):
+        return { "count": self.count, "sum": self.total,
+            "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99) }
+
+# How long replies waited between being PUT to /replies and being sent to the
+# owner over XMPP.  Only XMPPClient.process_replies_queue() writes to it.
+reply_latency = Histogram()
+
+# Number of HTTP requests handled by the REST API, keyed by (rail, status code).
+http_requests = {}
+http_lock = threading.Lock()
+
+# count_request(): Count an HTTP request.  Takes two args, the API rail and the
+#   status code sent back.
+def count_request(rail, code):
+    with http_lock:
+        http_requests[(rail, code)] = http_requests.get((rail, code), 0) + 1
+    return
+
+# Escape a Prometheus label value.
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Format a number the way Prometheus likes.
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Render one histogram in Prometheus' text format.  Takes the name of the
+# metric, the label text (like 'queue="foo"') or "", and the histogram.
+# Returns a list of lines.
+def _prometheus_histogram(name, labels, histogram):
+    lines = []
+    separator = "," if labels else ""
+
+    for bound, count in histogram.cumulative():
+        lines.append("%s_bucket{%s%sle=\"%s\"} %d" % (name, labels, separator,
+            _number(bound), count))
+    if labels:
+        labels = "{" + labels + "}"
+    lines.append("%s_sum%s %s" % (name, labels, _number(histogram.total)))
+    lines.append("%s_count%s %d" % (name, labels, histogram.count))
+    return lines
+
+# render_prometheus(): Render all of the metrics in Prometheus' text exposition
+#   format.  Takes one arg, the hash table of message queues.  Returns a
+#   string.
+def render_prometheus(queues):
+    lines = []
+
+    with http_lock:
+        requests = dict(http_requests)
+
+    queue_stats = [(name, queue.stats()) for name, queue in list(queues.items())]
+    for metric, kind, text, key in (
+            ("exocortex_queue_depth", "gauge", "Items waiting in the message queue.", "depth"),
+            ("exocortex_queue_bytes", "gauge", "Bytes of items waiting in the message queue.", "bytes"),
+            ("exocortex_queue_oldest_age_seconds", "gauge", "Age of the oldest item in the message queue.", "oldest age"),
+            ("exocortex_queue_leased", "gauge", "Items leased out of the message queue.", "leased"),
+            ("exocortex_queue_enqueued_total", "counter", "Items added to the message queue.", "enqueued"),
+            ("exocortex_queue_dequeued_total", "counter", "Items taken out of the message queue.", "dequeued"),
+            ("exocortex_queue_rejected_total", "counter", "Items refused because the message queue was full.", "rejected"),
+            ("exocortex_queue_dropped_total", "counter", "Items thrown away to make room in the message queue.", "dropped")):
+        lines.append("# HELP %s %s" % (metric, text))
+        lines.append("# TYPE %s %s" % (metric, kind))
+        for name, stats in queue_stats:
+            lines.append("%s{queue=\"%s\"} %s" % (metric, _label(name),
+                _number(stats[key])))
+
+    lines.append("# HELP exocortex_queue_wait_seconds Time between an item being added to a message queue and being taken out.")
+    lines.append("# TYPE exocortex_queue_wait_seconds histogram")
+    for name, queue in list(queues.items()):
+        lines.extend(_prometheus_histogram("exocortex_queue_wait_seconds",
+            "queue=\"%s\"" % _label(name), queue.wait_time))
+
+    lines.append("# HELP exocortex_reply_latency_seconds Time between a reply being PUT to /replies and being sent over XMPP.")
+    lines.append("# TYPE exocortex_reply_latency_seconds histogram")
+    lines.extend(_prometheus_histogram("exocortex_reply_latency_seconds", "",
+        reply_latency))
+
+    lines.append("# HELP exocortex_http_requests_total HTTP requests handled by the REST API.")
+    lines.append("# TYPE exocortex_http_requests_total counter")
+    for (rail, code), count in sorted(requests.items()):
+        lines.append("exocortex_http_requests_total{rail=\"%s\",code=\"%s\"} %d" %
+            (_label(rail), code, count))
+    return "\n".join(lines) + "\n"
+
+# render_json(): Render all of the metrics as a hash table that can be turned
+#   into JSON.  Latency histograms are summarized as percentiles.  Takes one
+#   arg, the hash table of message queues.
+def render_json(queues):
+    document = {"queues": {}, "replies": reply_latency.summary(),
+        "http requests": []}
+
+    for name, queue in list(queues.items()):
+        document["queues"][name] = queue.stats()
+        document["queues"][name]["wait time"] = queue.wait_time.summary()
+    with http_lock:
+        for (rail, code), count in sorted(http_requests.items()):
+            document["http requests"].append({"rail": rail, "code": code,
+                "count": count})
+    return document
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
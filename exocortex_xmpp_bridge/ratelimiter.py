@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# ratelimiter.py - A module of the Exocortex XMPP Bridge that implements a
+#   token bucket, which is used to pace the messages the bridge sends to the
+#   XMPP server so that bursts of replies go out as quickly as the server will
+#   put up with, and no quicker.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import sys
+import time
+
+# TokenBucket: Classic token bucket.  Tokens drip into the bucket at a steady
+#   rate (per second) up to a maximum (the burst size), and every message sent
+#   costs one token.  If the bucket is empty, the message has to wait.
+class TokenBucket(object):
+
+    # Initialize new instances of the class.  Takes two args, the number of
+    # tokens added per second and the most tokens the bucket can hold.  The
+    # bucket starts out full.
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+
+    # Top the bucket up with however many tokens have dripped in since the
+    # last time it was checked.
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+            self.tokens + ((now - self.last_refill) * self.rate))
+        self.last_refill = now
+        return
+
+    # Try to take a token out of the bucket.  Returns True if there was one,
+    # False if there wasn't.
+    def consume(self):
+        self.refill()
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    # Fill the bucket back up to its burst size.
+    def reset(self):
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        return
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
@@ -8,6 +8,70 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v5.22 - Requests with a negative Content-Length, or one bigger than
+#        max_content_bytes, are refused before anything is read.
+# v5.21 - Leaf bridges have to send their shared secret with every request.
+# v5.20 - Single-threaded servers don't keep connections open between
+#        requests, and refuse to stream commands.
+# v5.19 - Commands sent to leaf bridges are leased, and the leaves acknowledge
+#        them with PUT /federation/<leaf>/ack.
+# v5.18 - Request bodies can be compressed with gzip (Content-Encoding: gzip)
+#        on every rail, not just the federation ones, and responses bigger
+#        than compress_threshold are compressed for clients that send
+#        Accept-Encoding: gzip.  Compressed bodies that blow up past
+#        max_content_bytes are refused.
+# v5.17 - Added the /federation/<leaf> rails, which leaf bridges use to
+#        register their agents with this one, long-poll for their agents'
+#        commands in batches, and send their bots' replies, all compressed
+#        with gzip (see federation.py).
+# v5.16 - Added UnixHTTPServer and BoundedThreadingUnixHTTPServer, which
+#        serve the same REST API over a Unix domain socket for bots running
+#        on the same machine.
+# v5.15 - PUT /replies returns a 429 with a Retry-After header if the
+#        replies queue is full.
+# v5.14 - If a command is being traced, its trace ID goes to the bot along
+#        with it ("trace", or "traces" for batches), and a bot can send it
+#        back as "trace" in its reply so the round trip can be followed.
+# v5.13 - Added GET /metrics, which reports queue depths, the ages of the
+#        oldest items, enqueue and dequeue counters, latency histograms, and
+#        the number of HTTP requests handled per rail and status code, in
+#        Prometheus' text format (or JSON with ?format=json).
+# v5.12 - Added GET /<agent>/stream, which holds the connection open and
+#        pushes commands to the bot as Server-Sent Events the moment they're
+#        added to its queue.  Every event has the command's sequence number as
+#        its ID, so a bot that reconnects with a Last-Event-ID header gets
+#        anything it missed sent to it again.
+# v5.11 - Added leases.  GET /<agent>?lease=<n> hands out a command along with
+#        a lease ID instead of removing it from the queue for good.  The bot
+#        acknowledges it with PUT /<agent>/ack when it's done; if it doesn't
+#        within n seconds the command goes back into the queue.  This makes it
+#        safe to run more than one copy of a bot against the same queue.
+# v5.10 - Replies are queued as hash tables with the name of the bot and the
+#        reply so that the XMPP client can merge replies from the same bot.
+# v5.9 - GET / also reports how many replies are waiting to be sent and how
+#        long the oldest one has been waiting.
+# v5.8 - PUT /replies also accepts a JSON array of replies, which are all
+#        checked and then added to the replies queue in order in one go.
+# v5.7 - Added GET /<agent>?max=<n>, which returns up to n commands at once
+#        as {"commands": [...]} so bots that fall behind can catch up in one
+#        request.  Works with ?wait=<n> too.
+# v5.6 - RESTRequestHandler now speaks HTTP/1.1 with persistent connections.
+#        Every response goes through _send_http_response() so that it always
+#        has a correct Content-Length header, and idle connections are closed
+#        after a configurable timeout.
+#      - Error responses are now built as hash tables instead of being JSON
+#        strings that got serialized a second time.
+#      - Fixed the malformed "Content-Type:" headers.
+# v5.5 - Added BoundedThreadingHTTPServer, which services requests on
+#        separate threads (so one slow client can't stall every other bot's
+#        polls) while capping the number of threads that can be running at
+#        any one time.
+# v5.4 - Uses the AgentQueue API in message_queue.py instead of poking at
+#        lists directly.
+# v5.3 - Added long-polling to the per-agent rails.  GET /<agent>?wait=<n>
+#        parks the request for up to n seconds until a command for that agent
+#        shows up, so bots get their commands right away and aren't stuck
+#        hitting the bridge over and over just to get back "no commands."
 # v5.2 - Cleaned up generated strings by making them more pythonic.
 #      - There are some things that I can make more efficient by generating
 #        them once as hash tables and passing them to the methods that get
@@ -54,91 +118,285 @@
 # TODO:
 # - Write a signal handler that makes the agent reload its configuration file
 #   (whether it's the default one or specified on the command line).
-# - Consider adding a SQLite database to serialize the message queues to in
-#   the event the microservice ABENDs or gets shut down.  Don't forget a
-#   scream-and-die error message to not leave the user hanging.
 # - Maybe add a signal handler that'll cause the bot to dump its message queues
 #   to the database without dying?
-# - Figure out how to make slightly-mistyped search agent names (like all-
-#   lowercase instead of proper capitalization, or proper capitalization
-#   instead of all caps) match when search requests are pushed into the
-#   message queue.  I think I can do this, I just need to play with it.
 
 # By: The Doctor <drwho at virtadpt dot net>
 #     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
 
 # License: GPLv3
 
-from http.server import BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
 
+import errno
+import gzip
 import json
 import logging
+import math
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import zlib
 
+import federation
 import message_queue
+import metrics
+import tracing
 
 # Globals.
 
+# BoundedThreadingHTTPServer: Subclass of ThreadingHTTPServer that handles
+#   every request in its own thread, but never runs more than max_workers of
+#   them at the same time.  When every worker is busy the listener stops
+#   accepting connections until one frees up, so new connections wait in the
+#   kernel's listen backlog instead of piling up threads.
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+
+    # Don't make the bridge wait for stuck requests when it shuts down.
+    daemon_threads = True
+
+    # Initialize new instances of the class.  Takes the same arguments as
+    # HTTPServer plus the maximum number of worker threads.
+    def __init__(self, server_address, handler_class, max_workers=64):
+        self.max_workers = max_workers
+        self.workers = threading.BoundedSemaphore(max_workers)
+        ThreadingHTTPServer.__init__(self, server_address, handler_class)
+
+    # Wait for a worker to free up before handing the connection off to a new
+    # thread.
+    def process_request(self, request, client_address):
+        self.workers.acquire()
+        try:
+            ThreadingHTTPServer.process_request(self, request, client_address)
+        except:
+            self.workers.release()
+            raise
+
+    # Give the worker back when the thread is done with the connection.
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingHTTPServer.process_request_thread(self, request,
+                client_address)
+        finally:
+            self.workers.release()
+
+# UnixSocketMixIn: Makes an HTTP server listen on a Unix domain socket instead
+#   of a TCP port.  The server address is the path to the socket.  The
+#   socket's permissions are set to socket_mode so that only the user the
+#   bridge runs as (and the bots running as the same user) can connect.
+class UnixSocketMixIn(object):
+    address_family = socket.AF_UNIX
+    socket_mode = 0o600
+
+    # Get rid of the socket left over from the last time the bridge ran, bind
+    # the socket, and lock it down.  If something that isn't a socket is in
+    # the way, it's probably a typo in the config file, so leave it alone and
+    # raise an OSError.  HTTPServer.server_bind() wants a hostname and a port,
+    # which a Unix domain socket doesn't have.
+    def server_bind(self):
+        if os.path.lexists(self.server_address):
+            if not self._is_socket():
+                raise FileExistsError(errno.EEXIST,
+                    "Not replacing something that isn't a socket",
+                    self.server_address)
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        os.chmod(self.server_address, self.socket_mode)
+        self.server_name = "localhost"
+        self.server_port = 0
+        return
+
+    # Clients of a Unix domain socket don't have an address, so use the path
+    # to the socket for logging.
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        return (request, (self.server_address, 0))
+
+    # Clean up the socket when the server shuts down.
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        if self._is_socket():
+            os.unlink(self.server_address)
+        return
+
+    # Figure out whether the path to the socket is a socket.  Returns True or
+    # False.
+    def _is_socket(self):
+        try:
+            return stat.S_ISSOCK(os.lstat(self.server_address).st_mode)
+        except OSError:
+            return False
+
+# UnixHTTPServer: An HTTPServer that listens on a Unix domain socket and
+#   handles one request at a time.
+class UnixHTTPServer(UnixSocketMixIn, HTTPServer):
+    pass
+
+# BoundedThreadingUnixHTTPServer: A BoundedThreadingHTTPServer that listens on
+#   a Unix domain socket.
+class BoundedThreadingUnixHTTPServer(UnixSocketMixIn,
+        BoundedThreadingHTTPServer):
+    pass
+
 # RESTRequestHandler: Subclass that implements a REST API service.  The main
 #   rails are the names of agents or constructs that will poll message queues
 #   for commands.  Each time they poll, they get a JSON dump of the next
-#   command waiting for them in chronological order.
+#   command waiting for them in chronological order.  Speaks HTTP/1.1, so
+#   bots can keep their connections open between requests.
 class RESTRequestHandler(BaseHTTPRequestHandler):
 
+    # Use persistent connections.  This means that every response has to have
+    # a correct Content-Length header.
+    protocol_version = "HTTP/1.1"
+
+    # Number of seconds an idle persistent connection is held open before the
+    # bridge hangs up.  exocortex_xmpp_bridge.py overrides this from the config
+    # file.
+    timeout = 30
+
+    # The headers and the body of a response go out in separate writes, which
+    # on a persistent connection runs headlong into Nagle's algorithm and
+    # delayed ACKs (about 40ms per response).  Turn Nagle off.
+    disable_nagle_algorithm = True
+
     # Constants that make a few things easier later on.
     required_keys = ["name", "reply"]
 
+    # Upper limit on the number of seconds a long-polling request is allowed to
+    # park for.  exocortex_xmpp_bridge.py overrides this from the config file.
+    max_wait = 60
+
+    # Upper limit on the number of commands a bot can pull out of its queue in
+    # one request.
+    max_batch = 100
+
+    # Upper limit on the number of seconds a command can be leased for.
+    max_lease = 3600
+
+    # How often (in seconds) a comment is sent over a quiet event stream so
+    # that the connection doesn't look dead.
+    stream_heartbeat = 15
+
+    # Number of seconds a bot is told to wait before trying again when the
+    # replies queue is full.
+    retry_after = 5
+
+    # Responses at least this many bytes long are compressed with gzip if the
+    # client says it can take it (0 turns compression off).
+    # exocortex_xmpp_bridge.py overrides this from the config file.
+    compress_threshold = 1024
+
+    # Upper limit on the size of a request body, both as it's sent and after
+    # it's decompressed, so neither a huge request nor a tiny gzip bomb can
+    # eat all of the bridge's memory.
+    max_content_bytes = 16777216
+
+    # Nagle's algorithm is a TCP thing, so don't try to turn it off on a Unix
+    # domain socket.  A server that handles one request at a time can't hold
+    # connections open between requests, because one bot that keeps its
+    # connection open would lock every other bot out until it went idle, so
+    # those speak HTTP/1.0 and hang up after every response.
+    def setup(self):
+        if self.request.family == socket.AF_UNIX:
+            self.disable_nagle_algorithm = False
+        if not isinstance(self.server, socketserver.ThreadingMixIn):
+            self.protocol_version = "HTTP/1.0"
+        BaseHTTPRequestHandler.setup(self)
+        return
+
     # Process HTTP/1.1 GET requests.
     def do_GET(self):
-        # This is a handle for serialized JSON before it's converted into bytes.
-        message = None
-
         # If someone requests /, return the current internal configuration of
         # this bot in an attempt to be helpful.
         if self.path == '/':
             logging.debug("User requested /.  Returning list of configured agents.")
-            self.send_response(200)
-            self.send_header("Content-type:", "application/json")
-            self.end_headers()
-            message = json.dumps({ "active agents":
-                list(message_queue.message_queue.keys()) }).encode()
-            self.wfile.write(message)
+            self._send_http_response(200, { "active agents":
+                list(message_queue.message_queue.keys()),
+                "replies": {
+                    "depth": message_queue.message_queue["replies"].depth(),
+                    "oldest age": message_queue.message_queue["replies"].oldest_age()
+                },
+                "leaves": federation.status() })
+            return
+
+        # Split the query string (if any) off of the API rail.
+        agent, arguments = self._parse_path()
+
+        # Performance metrics for the bridge.
+        if agent == "metrics":
+            self._send_metrics(arguments)
+            return
+
+        # A leaf bridge picking up commands for its agents.
+        if agent.startswith("federation/"):
+            if self._ensure_leaf(agent[len("federation/"):]):
+                self._send_leaf_commands(agent[len("federation/"):],
+                    arguments)
+            return
+
+        # If the agent wants its commands pushed to it, start streaming.  A
+        # stream ties up a thread for as long as it's open, so a server that
+        # only has the one can't do it.
+        if agent.endswith("/stream") and agent[:-len("/stream")] in list(message_queue.message_queue.keys()):
+            if not isinstance(self.server, socketserver.ThreadingMixIn):
+                self._send_error_response(503, "Streaming isn't available when the bridge's REST API server is in single mode.  Poll instead.")
+                return
+            self._stream(agent[:-len("/stream")])
             return
 
         # Figure out if the base API rail contacted is one of the agents
         # pulling requests from this bot.  If not, return a 404.
-        agent = self.path.strip('/')
         if agent not in list(message_queue.message_queue.keys()):
             logging.debug("Message queue for agent %s not found." % agent)
-            self.send_response(404)
-            self.send_header("Content-type:", "application/json")
-            self.end_headers()
-            message = json.dumps({agent: "not found"}).encode()
-            self.wfile.write(message)
+            self._send_http_response(404, {agent: "not found"})
+            return
+
+        # If the agent asked to long-poll, park the request until a command
+        # shows up or the timeout expires.  Otherwise check the queue once and
+        # bounce.
+        wait = self._get_wait(arguments)
+        if wait:
+            logging.debug("Agent %s is long-polling for up to %s seconds." %
+                (agent, wait))
+
+        # If the agent asked for a batch of commands, pull as many as it asked
+        # for (up to a limit) out of the queue all at once and send them back
+        # as a list, earliest first.  The list is empty if nothing's waiting.
+        batch = self._get_batch_size(arguments)
+
+        # If the agent asked to lease commands, hand them out along with their
+        # lease IDs.
+        lease = self._get_lease(arguments)
+        if lease:
+            self._send_leases(agent, batch, lease, wait)
             return
 
+        if batch:
+            entries = message_queue.message_queue[agent].get_entries(batch,
+                wait)
+            logging.debug("Returning %d commands from message queue %s." %
+                (len(entries), agent))
+            self._send_http_response(200, self._commands_document(entries))
+            return
+
+        entries = message_queue.message_queue[agent].get_entries(1, wait)
+
         # If the message queue is empty, return an error JSON document.
-        if not len(message_queue.message_queue[agent]):
+        if not entries:
             logging.debug("Message queue for agent %s is empty." % agent)
-            self.send_response(200)
-            self.send_header("Content-Type:", "application/json")
-            self.end_headers()
-            message = json.dumps({"command": "no commands"}).encode()
-            self.wfile.write(message)
+            self._send_http_response(200, {"command": "no commands"})
             return
 
-        # Extract the earliest command from the agent's message queue.
-        command = message_queue.message_queue[agent].pop(0)
-
         # Assemble a JSON document of the earliest pending command.  Then send
         # the JSON document to the agent.  Multiple hits will be required to
         # empty the queue.
         logging.debug("Returning earliest command from message queue %s: %s" %
-            (agent, command))
-        self.send_response(200)
-        self.send_header("Content-Type:", "application/json")
-        self.end_headers()
-        message = json.dumps({"command": command}).encode()
-        self.wfile.write(message)
+            (agent, entries[0].item))
+        self._send_http_response(200, self._command_document(entries[0]))
         return
 
     # Replies from a construct will look like this:
@@ -147,30 +405,51 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
     #   "name": "<bot's name>",
     #   "reply": "<The bot's witty repartee' goes here.>"
     # }
+    #
+    # If the command the bot is replying to came with a trace ID, the bot can
+    # send it back as "trace": "<trace ID>".
+    #
+    # A construct that has a bunch of replies to send can put them into a JSON
+    # array and send them all at once:
+    #
+    # [
+    #   { "name": "<bot's name>", "reply": "<First reply.>" },
+    #   { "name": "<bot's name>", "reply": "<Second reply.>" }
+    # ]
 
     # Process HTTP/1.1 PUT requests.
     def do_PUT(self):
-        # This is a handle for serialized JSON before it's converted into bytes.
-        message = None
-
-        content = ""
-        content_length = 0
-        response = {}
-        reply = ""
+        rail = self.path.strip('/')
 
         # Figure out if the API rail is the 'replies' rail, meaning that a
-        # construct wants to send a response back to the user.  If not, return
-        # a 404.
-        agent = self.path.strip('/')
-        if agent != "replies":
-            logging.debug("Something tried to PUT to API rail /%s.  Better make sure it's not a bug." % agent)
-            self.send_response(404)
-            self.send_header("Content-Type:", "application/json")
-            self.end_headers()
-            message = json.dumps({agent: "not found"}).encode()
-            self.wfile.write(message)
+        # construct wants to send a response back to the user.
+        if rail == "replies":
+            self._put_replies()
             return
 
+        # A leaf bridge registering its agents or sending its bots' replies.
+        if rail.startswith("federation/"):
+            self._put_federation(rail[len("federation/"):])
+            return
+
+        # The other thing a construct can PUT is an acknowledgement of a
+        # leased command.
+        if rail.endswith("/ack") and rail[:-len("/ack")] in list(message_queue.message_queue.keys()):
+            self._put_ack(rail[:-len("/ack")])
+            return
+
+        # Otherwise, return a 404.  The body of the request is never read, so
+        # the connection can't be reused afterward.
+        logging.debug("Something tried to PUT to API rail /%s.  Better make sure it's not a bug." % rail)
+        self.close_connection = True
+        self._send_http_response(404, {rail: "not found"})
+        return
+
+    # Process a PUT to the /replies rail.
+    def _put_replies(self):
+        content = ""
+        response = {}
+
         logging.info("A construct has contacted the /replies API rail.")
         logging.debug("List of headers in the HTTP request:")
         for key in self.headers:
@@ -180,8 +459,7 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
         # "Content-Length" header something screwy is happening because that
         # breaks the HTTP spec so fire an error.
         content = self._read_content()
-        if not content:
-            logging.debug("Client sent zero-length content.")
+        if content is None:
             return
 
         # Try to deserialize the JSON sent from the client.  If we can't,
@@ -189,63 +467,621 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
         if not self._ensure_json():
             return
         response = self._deserialize_content(content)
+        if response is None:
+            return
+        self._queue_replies(response)
+        return
+
+    # Check a reply or a list of replies and add them to the replies queue.
+    # Takes one arg, the deserialized JSON the client sent.
+    def _queue_replies(self, response):
+        replies = []
+
+        # A single reply gets treated like a batch of one.
+        if not isinstance(response, list):
+            response = [response]
         if not response:
+            self._send_error_response(400, "You sent an empty list of replies.")
+            return
+
+        # Check every reply in the batch before queuing any of them, so that
+        # either all of them go out or none of them do.
+        for i in response:
+            if not isinstance(i, dict):
+                self._send_error_response(400, "Every reply has to be a JSON document.  Look at the online help.")
+                return
+
+            # Normalize the keys in the JSON to lowercase.
+            i = self._normalize_keys(i)
+
+            # Ensure that all of the required keys are in the JSON document.
+            if not self._ensure_all_keys(i):
+                return
+
+            # The XMPP client formats the reply when it's sent, because
+            # replies from the same bot might be sent together.
+            replies.append({"name": i["name"], "reply": i["reply"]})
+            if i.get("trace"):
+                replies[-1]["trace"] = str(i["trace"])
+
+        # Add the replies to the bot's private message queue.
+        logging.debug("Adding %d replies to the replies queue." % len(replies))
+        try:
+            message_queue.message_queue["replies"].put_many(replies)
+        except message_queue.QueueFull:
+            logging.warning("The replies queue is full, refusing %d replies." %
+                len(replies))
+            self._send_error_response(429, "The replies queue is full.  Try again later.",
+                {"Retry-After": str(self.retry_after)})
+            return
+        for i in replies:
+            if "trace" in i:
+                tracing.mark(i["trace"], "reply received")
+        self._send_http_response(200, None)
+        return
+
+    # Acknowledgements of leased commands look like this:
+    #
+    # {
+    #   "id": <lease ID>
+    # }
+    #
+    # "id" can also be a list of lease IDs.
+
+    # Process a PUT to an agent's /ack rail.  Takes one arg, the name of the
+    # agent.
+    def _put_ack(self, agent):
+        content = ""
+        arguments = {}
+        lease_ids = []
+        acknowledged = []
+        expired = []
+
+        content = self._read_content()
+        if content is None:
+            return
+        if not self._ensure_json():
+            return
+        arguments = self._deserialize_content(content)
+        if arguments is None:
+            return
+        if not isinstance(arguments, dict) or "id" not in arguments:
+            self._send_error_response(400, "You need to send the lease ID of the command you're acknowledging.")
+            return
+
+        lease_ids = arguments["id"]
+        if not isinstance(lease_ids, list):
+            lease_ids = [lease_ids]
+        if not self._ensure_lease_ids(lease_ids):
+            return
+        for i in lease_ids:
+            if message_queue.message_queue[agent].ack(i):
+                acknowledged.append(i)
+            else:
+                expired.append(i)
+        logging.debug("Agent %s acknowledged leases %s." % (agent, acknowledged))
+
+        # If any of the leases couldn't be found, they already ran out and
+        # their commands went back into the queue, so tell the bot.
+        if expired:
+            logging.debug("Leases %s for agent %s weren't found." %
+                (expired, agent))
+            self._send_http_response(404, {"acknowledged": acknowledged,
+                "not found": expired})
+            return
+        self._send_http_response(200, {"acknowledged": acknowledged})
+        return
+
+    # Registrations from leaf bridges look like this:
+    #
+    # {
+    #   "agents": ["<agent>", "<agent>", ...],
+    #   "aliases": { "<agent>": ["<alias>", ...], ... }
+    # }
+    #
+    # Replies from a leaf bridge look just like a batch of replies PUT to
+    # /replies.  Both are compressed with gzip.
+
+    # Process a PUT to one of the /federation/<leaf> rails.  Takes one arg,
+    # the rest of the API rail.
+    def _put_federation(self, rail):
+        leaf = rail.split("/")[0]
+        content = None
+        document = None
+        registered = []
+        refused = []
+
+        if rail not in (leaf, leaf + "/replies", leaf + "/ack"):
+            self.close_connection = True
+            self._send_http_response(404, {"federation/" + rail: "not found"})
+            return
+        if not self._ensure_leaf(leaf):
+            return
+
+        content = self._read_content()
+        if content is None:
+            return
+        if not self._ensure_json():
+            return
+        document = self._deserialize_content(content)
+        if document is None:
             return
 
-        # Normalize the keys in the JSON to lowercase.
-        response = self._normalize_keys(response)
+        if rail.endswith("/replies"):
+            logging.debug("Leaf %s sent replies." % leaf)
+            self._queue_replies(document)
+            return
+        if rail.endswith("/ack"):
+            self._put_leaf_ack(leaf, document)
+            return
 
-        # Ensure that all of the required keys are in the JSON document.
-        if not self._ensure_all_keys(response):
+        if not isinstance(document, dict) or not isinstance(document.get("agents"), list):
+            self._send_error_response(400, "You need to send the list of agents that are on your leaf.")
             return
+        registered, refused = federation.register(leaf,
+            [str(i) for i in document["agents"]],
+            document.get("aliases") or {})
+        self._send_http_response(200, {"registered": registered,
+            "refused": refused})
+        return
+
+    # Acknowledgements from a leaf bridge look like this:
+    #
+    # {
+    #   "<agent>": [<lease ID>, <lease ID>, ...],
+    #   ...
+    # }
+
+    # Acknowledge the commands a leaf bridge got.  Takes two args, the name of
+    # the leaf and the deserialized JSON it sent.
+    def _put_leaf_ack(self, leaf, document):
+        expired = []
+
+        if not isinstance(document, dict) or not all(isinstance(i, list)
+                for i in document.values()):
+            self._send_error_response(400, "You need to send lists of lease IDs for each agent.")
+            return
+        for lease_ids in document.values():
+            if not self._ensure_lease_ids(lease_ids):
+                return
+        expired = federation.ack(leaf, document)
+        if expired:
+            logging.debug("Leases %s for leaf %s weren't found." %
+                (expired, leaf))
+            self._send_http_response(404, {"not found": expired})
+            return
+        self._send_http_response(200, None)
+        return
+
+    # Send every command waiting for a leaf bridge's agents to it, in
+    # batches, long-polling if it asked to.  The commands are leased for as
+    # long as the leaf asked (or federation.lease_time).  Looks like this
+    # (compressed with gzip if the leaf can take it):
+    #
+    # {
+    #   "commands": {
+    #     "<agent>": { "commands": [...], "traces": [...], "ids": [...] },
+    #     ...
+    #   }
+    # }
+    #
+    # Takes two args, the name of the leaf and the query string arguments.
+    def _send_leaf_commands(self, leaf, arguments):
+        collected = {}
+        document = {}
 
-        # Generate a reply to the bot's owner and add it to the bot's private
-        # message queue.
-        reply = "Got a message from " + response['name'] + ":\n\n"
-        reply = reply + response['reply']
-        message_queue.message_queue['replies'].append(reply)
+        collected = federation.collect(leaf,
+            self._get_batch_size(arguments) or self.max_batch,
+            self._get_wait(arguments),
+            self._get_lease(arguments) or federation.lease_time)
+        if collected is None:
+            self._send_http_response(404, {leaf: "not registered"})
+            return
+        for agent, leased in collected.items():
+            document[agent] = self._commands_document([entry for lease_id, entry in leased])
+            document[agent]["ids"] = [lease_id for lease_id, entry in leased]
+        logging.debug("Sending commands for %d agents to leaf %s." %
+            (len(document), leaf))
+        self._send_http_response(200, {"commands": document})
+        return
+
+    # Make sure a leaf bridge is allowed to talk to this one and sent its
+    # shared secret (Authorization: Bearer <secret>).  If it isn't, or it
+    # didn't, send it a 403.  Takes one arg, the name of the leaf.  Returns
+    # True or False.
+    def _ensure_leaf(self, leaf):
+        authorization = self.headers.get("Authorization", "").strip()
+        secret = ""
+
+        if authorization[:7].lower() == "bearer ":
+            secret = authorization[7:].strip()
+        if federation.authorized(leaf, secret):
+            return True
+        logging.warning("Something claiming to be leaf %s tried to contact this bridge." %
+            leaf)
+        self.close_connection = True
+        self._send_error_response(403, "Leaf %s isn't allowed to federate with this bridge." %
+            leaf)
+        return False
+
+    # Make sure every lease ID a client sent is an integer, and send it a 400
+    # if they aren't.  Takes one arg, a list of lease IDs.  Returns True or
+    # False.
+    def _ensure_lease_ids(self, lease_ids):
+        for i in lease_ids:
+            if not isinstance(i, int) or isinstance(i, bool):
+                self._send_error_response(400, "Lease IDs have to be integers, not %s." %
+                    json.dumps(i))
+                return False
+        return True
+
+    # Send the bridge's performance metrics to the client, in Prometheus' text
+    # format unless the "format" query string argument is "json".
+    def _send_metrics(self, arguments):
+        if arguments.get("format", [""])[0] == "json":
+            self._send_http_response(200,
+                metrics.render_json(message_queue.message_queue))
+            return
+        self._send_body(200,
+            metrics.render_prometheus(message_queue.message_queue).encode(),
+            "text/plain; version=0.0.4; charset=utf-8")
+        return
+
+    # Push commands to an agent as Server-Sent Events
+    # (https://html.spec.whatwg.org/multipage/server-sent-events.html) until
+    # the agent hangs up.  Each event looks like this:
+    #
+    # id: <sequence number>
+    # data: {"command": "<command>"}
+    #
+    # If the agent sends a Last-Event-ID header when it connects, anything
+    # sent after that event that's still remembered is sent again first.
+    # Takes one arg, the name of the agent.
+    def _stream(self, agent):
+        queue = message_queue.message_queue[agent]
+        last_event_id = 0
+        stream = 0
+        entry = None
+
+        try:
+            last_event_id = int(self.headers.get("Last-Event-ID", 0))
+        except ValueError:
+            logging.debug("Agent %s sent a bogus Last-Event-ID: %s" %
+                (agent, self.headers["Last-Event-ID"]))
+
+        # There's no Content-Length, so the end of the stream is the end of
+        # the connection.
+        self.close_connection = True
         self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
         self.end_headers()
+        logging.info("Agent %s is streaming its message queue." % agent)
+
+        # Only one stream per agent is serviced at a time.  This one bumps any
+        # older stream, which is most likely a connection that dropped without
+        # the bridge noticing yet.
+        stream = queue.open_stream()
+
+        try:
+            if last_event_id:
+                for entry in queue.streamed_since(last_event_id):
+                    logging.debug("Resending event %d to agent %s." %
+                        (entry.seq, agent))
+                    self._send_event(entry)
+
+            while queue.stream == stream:
+                entry = queue.get_streamed(stream, self.stream_heartbeat)
+                if entry:
+                    logging.debug("Streaming command to agent %s: %s" %
+                        (agent, entry.item))
+                    self._send_event(entry)
+                elif queue.stream == stream:
+                    self.wfile.write(b": keepalive\n\n")
+        except OSError:
+            logging.info("Agent %s stopped streaming its message queue." %
+                agent)
+            return
+        logging.info("A newer stream for agent %s replaced this one." % agent)
         return
 
+    # Send a queue entry over an event stream.
+    def _send_event(self, entry):
+        self.wfile.write(("id: %d\ndata: %s\n\n" % (entry.seq,
+            json.dumps(self._command_document(entry)))).encode())
+        return
+
+    # Build the JSON document that hands a single command to a bot, with its
+    # trace ID if it has one.  Takes one arg, the queue entry.
+    def _command_document(self, entry):
+        document = {"command": entry.item}
+
+        if entry.trace:
+            document["trace"] = entry.trace
+        return document
+
+    # Build the JSON document that hands a batch of commands to a bot.  If any
+    # of them are being traced, their trace IDs go in a list alongside the
+    # commands (null for any that aren't).  Takes one arg, a list of queue
+    # entries.
+    def _commands_document(self, entries):
+        document = {"commands": [entry.item for entry in entries]}
+
+        if any(entry.trace for entry in entries):
+            document["traces"] = [entry.trace for entry in entries]
+        return document
+
+    # Lease commands out of an agent's queue and send them to the agent.
+    # Takes four args, the name of the agent, the number of commands to lease
+    # (0 for the usual one-command response), the length of the lease in
+    # seconds, and the number of seconds to long-poll.
+    def _send_leases(self, agent, batch, lease, wait):
+        leased = []
+        document = {}
+
+        leased = message_queue.message_queue[agent].lease(max(batch, 1), lease,
+            wait)
+        logging.debug("Leased %d commands from message queue %s for %s seconds." %
+            (len(leased), agent, lease))
+
+        if batch:
+            document = self._commands_document([entry for lease_id, entry in leased])
+            document["ids"] = [lease_id for lease_id, entry in leased]
+            document["lease"] = lease
+            self._send_http_response(200, document)
+            return
+        if not leased:
+            self._send_http_response(200, {"command": "no commands"})
+            return
+        document = self._command_document(leased[0][1])
+        document["id"] = leased[0][0]
+        document["lease"] = lease
+        self._send_http_response(200, document)
+        return
+
+    # Split the requested path into the name of the API rail and a hash table
+    # of query string arguments.  Returns both.
+    def _parse_path(self):
+        url = urlsplit(self.path)
+        return (url.path.strip("/"), parse_qs(url.query))
+
+    # Figure out how long a GET request wants to long-poll for from the
+    # "wait" query string argument, clamped to max_wait.  Returns the number of
+    # seconds to wait, or 0 if the client isn't long-polling.
+    def _get_wait(self, arguments):
+        wait = 0.0
+
+        if "wait" not in arguments:
+            return 0
+        try:
+            wait = float(arguments["wait"][0])
+        except ValueError:
+            logging.debug("Client sent a bogus wait value: %s" %
+                arguments["wait"][0])
+            return 0
+
+        # NaN and infinity parse just fine, but a deadline that's NaN never
+        # comes.
+        if not math.isfinite(wait) or wait <= 0:
+            return 0
+        return min(wait, self.max_wait)
+
+    # Figure out how many commands a GET request wants at once from the "max"
+    # query string argument, clamped to max_batch.  Returns the number of
+    # commands, or 0 if the client only wants the usual one.
+    def _get_batch_size(self, arguments):
+        batch = 0
+
+        if "max" not in arguments:
+            return 0
+        try:
+            batch = int(arguments["max"][0])
+        except ValueError:
+            logging.debug("Client sent a bogus max value: %s" %
+                arguments["max"][0])
+            return 0
+        if batch <= 0:
+            return 0
+        return min(batch, self.max_batch)
+
+    # Figure out how long a GET request wants to lease commands for from the
+    # "lease" query string argument, clamped to max_lease.  Returns the number
+    # of seconds, or 0 if the client isn't leasing.
+    def _get_lease(self, arguments):
+        lease = 0.0
+
+        if "lease" not in arguments:
+            return 0
+        try:
+            lease = float(arguments["lease"][0])
+        except ValueError:
+            logging.debug("Client sent a bogus lease value: %s" %
+                arguments["lease"][0])
+            return 0
+
+        # A lease that runs out at NaN never runs out.
+        if not math.isfinite(lease) or lease <= 0:
+            return 0
+        return min(lease, self.max_lease)
+
     # Send an HTTP response, consisting of the status code, headers and
-    # payload.  Takes two arguments, the HTTP status code and a JSON document
-    # containing an appropriate response.
-    def _send_http_response(self, code, response):
+    # payload.  Takes two arguments, the HTTP status code and a hash table
+    # containing an appropriate response (or None for an empty body), and an
+    # optional hash table of extra headers.  Every
+    # response goes through here so that Content-Length is always correct,
+    # which persistent connections depend on.
+    def _send_http_response(self, code, response, headers=None):
+        message = b""
+
+        if response is not None:
+            message = json.dumps(response).encode()
+        self._send_body(code, message, "application/json", headers)
+        return
+
+    # Send an HTTP response with an arbitrary body.  Takes three arguments, the
+    # HTTP status code, the body as bytes, and its Content-Type, plus an
+    # optional hash table of extra headers.  Big bodies are compressed if the
+    # client can take it.
+    def _send_body(self, code, message, content_type, headers=None):
+        headers = dict(headers or {})
+
+        # Whether the body is compressed depends on what the client sent, so
+        # caches have to know that.
+        if self.compress_threshold and len(message) >= self.compress_threshold:
+            headers["Vary"] = "Accept-Encoding"
+            if self._accepts_gzip():
+                message = gzip.compress(message, compresslevel=6)
+                headers["Content-Encoding"] = "gzip"
+
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        for header, value in headers.items():
+            self.send_header(header, value)
+        if message:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(message)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(json.dumps(response).encode())
+        self.wfile.write(message)
+        return
+
+    # Count every response sent, by API rail and status code.
+    def send_response(self, code, message=None):
+        metrics.count_request(self._rail_name(), code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
         return
 
-    # Read content from the client connection and return it as a string.
-    # Return None if there isn't any content.
+    # Figure out which API rail a request was for, for the metrics.  Anything
+    # that isn't a real rail is lumped together so that random requests can't
+    # make the list grow forever.
+    def _rail_name(self):
+        rail = urlsplit(getattr(self, "path", "")).path.strip("/")
+        agent = rail.split("/")[0]
+
+        if not rail:
+            return "/"
+        if rail in ("replies", "metrics"):
+            return "/" + rail
+        if agent == "federation":
+            return "/federation"
+        if agent in message_queue.message_queue and rail in (agent,
+                agent + "/stream", agent + "/ack"):
+            return "/" + rail
+        return "other"
+
+    # Build an error message, log it, and send it to the client.  Takes two
+    # arguments, the HTTP status code and the text of the error, and an
+    # optional hash table of extra headers.
+    def _send_error_response(self, code, error, headers=None):
+        response = {"result": None, "error": error, "id": code}
+        logging.debug("%s, %s" % (code, json.dumps(response)))
+        self._send_http_response(code, response, headers)
+        return
+
+    # Read content from the client connection and return it as bytes,
+    # decompressed if the client sent it compressed with gzip.  Return None if
+    # there isn't any content or it can't be used, after sending the client an
+    # error.  If the content couldn't be read the
+    # rest of the connection can't be trusted, so it gets closed.
     def _read_content(self):
-        content = ""
+        content = b""
         content_length = 0
+        encoding = self.headers.get("Content-Encoding", "identity").strip().lower()
 
         try:
             content_length = int(self.headers['Content-Length'])
+        except:
+            self.close_connection = True
+            self._send_error_response(500, "Client sent zero-lenth content.")
+            return None
+
+        # Don't read anything if the length is nonsense or too big to hold.
+        # Whatever the client sent is still sitting in the connection, so it
+        # can't be used for anything else.
+        if content_length < 0:
+            self.close_connection = True
+            self._send_error_response(400, "Content-Length can't be negative.")
+            return None
+        if content_length > self.max_content_bytes:
+            self.close_connection = True
+            self._send_error_response(413, "You sent more than %d bytes of content." %
+                self.max_content_bytes)
+            return None
+
+        try:
             content = self.rfile.read(content_length)
-            logging.debug("Content sent by client: %s" %
-                content.decode("ascii"))
         except:
-            # MOOF MOOF MOOF
-            # I can make this more elegant by building the response as a hash
-            # table, sending it to logging.debug() and sending it to
-            # self._send_http_response().  But I have bigger fish to fry right
-            # now.
-            logging.debug('{"result": null, "error": "Client sent zero-lenth content.", "id": 500}')
-            self._send_http_response(500, '{"result": null, "error": "Client sent zero-lenth content.", "id": 500}')
+            self.close_connection = True
+            self._send_error_response(500, "Client sent zero-lenth content.")
+            return None
+
+        if encoding == "gzip":
+            content = self._gunzip(content)
+            if content is None:
+                return None
+        elif encoding != "identity":
+            self._send_error_response(415, "Content-Encoding %s isn't supported.  Send gzip or nothing." %
+                encoding)
             return None
 
+        # Every request has to get a response, or a client on a persistent
+        # connection sits there until it times out.
+        if not content:
+            logging.debug("Client sent zero-length content.")
+            self._send_error_response(400, "You sent an empty request.")
+            return None
+        logging.debug("Content sent by client: %s" %
+            content.decode("utf-8", "replace"))
         return content
 
+    # Decompress a request body that was compressed with gzip, but not past
+    # max_content_bytes.  Returns the decompressed content, or None if it
+    # couldn't be decompressed (in which case the client has been sent an
+    # error).
+    def _gunzip(self, content):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        try:
+            content = decompressor.decompress(content,
+                self.max_content_bytes + 1)
+        except zlib.error:
+            self._send_error_response(400, "You sent content that says it's gzipped, but it isn't.")
+            return None
+        if len(content) > self.max_content_bytes:
+            self._send_error_response(413, "You sent more than %d bytes of content." %
+                self.max_content_bytes)
+            return None
+        if not decompressor.eof:
+            self._send_error_response(400, "The gzipped content you sent was cut off.")
+            return None
+        return content
+
+    # Figure out whether the client can take a response compressed with gzip
+    # from its Accept-Encoding header.  Returns True or False.
+    def _accepts_gzip(self):
+        encoding = ""
+        parameters = ""
+        quality = 1.0
+
+        for i in self.headers.get("Accept-Encoding", "").split(","):
+            encoding, _, parameters = i.partition(";")
+            if encoding.strip().lower() not in ("gzip", "x-gzip", "*"):
+                continue
+            quality = 1.0
+            parameters = parameters.strip().lower()
+            if parameters.startswith("q="):
+                try:
+                    quality = float(parameters[2:])
+                except ValueError:
+                    quality = 0.0
+            return quality > 0
+        return False
+
     # Ensure that the content from the client is JSON.
     def _ensure_json(self):
-        if "application/json" not in self.headers['Content-Type']:
-            logging.debug('{"result": null, "error": "You need to send JSON.", "id": 400}')
-            self._send_http_response(400, '{"result": null, "error": "You need to send JSON.", "id": 400}')
+        if "application/json" not in self.headers.get("Content-Type", ""):
+            self._send_error_response(400, "You need to send JSON.")
             return False
         else:
             return True
@@ -258,8 +1094,7 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
         try:
             arguments = json.loads(content.decode())
         except:
-            logging.debug('400, {"result": null, "error": "You need to send valid JSON.  That was not valid.", "id": 400}')
-            self._send_http_response(400, '{"result": null, "error": "You need to send valid JSON.  That was not valid.", "id": 400}')
+            self._send_error_response(400, "You need to send valid JSON.  That was not valid.")
             return None
 
         return arguments
@@ -281,8 +1116,7 @@ class RESTRequestHandler(BaseHTTPRequestHandler):
                 all_keys_found = False
 
         if not all_keys_found:
-            logging.debug('400, {"result": null, "error": "All required keys were not found in the JSON document.  Look at the online help.", "id": 400}')
-            self._send_http_response(400, '{"result": null, "error": "All required keys were not found in the JSON document.  Look at the online help.", "id": 400}')
+            self._send_error_response(400, "All required keys were not found in the JSON document.  Look at the online help.")
             return False
         else:
             return True
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# scheduler.py - A module of the Exocortex XMPP Bridge that holds on to
+#   commands that are supposed to be run later ("Downloadbot, at 02:00 get
+#   ..." or "Downloadbot, in 30 minutes get ...") and adds them to their
+#   agents' message queues when it's time.
+#
+#   Scheduled commands are kept in a heap ordered by when they're due, and a
+#   separate thread sleeps until the one at the top of the heap is due, so
+#   nothing has to look at every scheduled command over and over no matter
+#   how many of them there are.  If a database file is given, scheduled
+#   commands are also written to it so that they survive the bridge being
+#   restarted.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.1 - On a hub, scheduled commands for agents whose leaves haven't connected
+#        yet are tried again later instead of being thrown away.
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import datetime
+import heapq
+import logging
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import federation
+import message_queue
+import tracing
+
+# Handle to the Scheduler object, if scheduled commands are turned on.
+schedule = None
+
+# Regular expressions that match the two ways of scheduling a command: "at
+# HH:MM <command>" and "in N seconds|minutes|hours|days <command>".
+at_time = re.compile(r"^at\s+(\d{1,2}):(\d{2})\s+(.+)$", re.IGNORECASE | re.DOTALL)
+in_time = re.compile(r"^in\s+(\d+)\s*(s|sec|secs|seconds?|m|min|mins|minutes?|h|hr|hrs|hours?|d|days?)\s+(.+)$",
+    re.IGNORECASE | re.DOTALL)
+
+# Number of seconds in each unit of time "in N ..." understands, by first
+# letter.
+units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# parse_schedule(): Figure out whether a command is supposed to be run later.
+#   Takes two args, the command and the current time (from time.time()).
+#   Returns a tuple of the time the command is due (or None if it's not
+#   scheduled) and the command with the scheduling part taken off.
+def parse_schedule(command, now=None):
+    match = None
+    due = None
+    hour = 0
+    minute = 0
+
+    if now is None:
+        now = time.time()
+
+    match = at_time.match(command)
+    if match:
+        hour = int(match.group(1))
+        minute = int(match.group(2))
+        if hour > 23 or minute > 59:
+            return (None, command)
+
+        # The next time it's HH:MM local time, which might be tomorrow.
+        due = datetime.datetime.fromtimestamp(now).replace(hour=hour,
+            minute=minute, second=0, microsecond=0)
+        if due.timestamp() <= now:
+            due = due + datetime.timedelta(days=1)
+        return (due.timestamp(), match.group(3).strip())
+
+    match = in_time.match(command)
+    if match:
+        due = now + int(match.group(1)) * units[match.group(2)[0].lower()]
+        return (due, match.group(3).strip())
+
+    return (None, command)
+
+# Scheduler: Holds commands until they're due and then adds them to their
+#   agents' message queues.
+class Scheduler(object):
+
+    # Initialize new instances of the class.  Takes one optional arg, the path
+    # to the database file scheduled commands are saved in.  If it's not
+    # given, scheduled commands only exist in memory.
+    def __init__(self, path=None):
+        self.path = path
+
+        # Heap of (due time, ID, agent name, command) tuples.
+        self.heap = []
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+        # If a scheduled command can't be added to its agent's queue because
+        # the queue is full, try again after this many seconds.
+        self.retry_interval = 60
+
+        # Handle to the database.  Only touched while holding the condition
+        # variable.
+        self.database = None
+        self.next_id = 1
+        if path:
+            self.database = sqlite3.connect(path, check_same_thread=False)
+            self.database.execute("PRAGMA journal_mode = WAL")
+            self.database.execute("PRAGMA synchronous = NORMAL")
+            self.database.execute("CREATE TABLE IF NOT EXISTS scheduled (id INTEGER PRIMARY KEY, due REAL NOT NULL, agent TEXT NOT NULL, command TEXT NOT NULL)")
+            self.database.commit()
+            for row in self.database.execute("SELECT due, id, agent, command FROM scheduled"):
+                self.heap.append(row)
+            heapq.heapify(self.heap)
+            self.next_id = max([row[1] for row in self.heap] + [0]) + 1
+            logging.info("Loaded %d scheduled commands from %s." %
+                (len(self.heap), path))
+
+    # Schedule a command.  Takes three args, the time it's due (from
+    # time.time()), the name of the agent, and the command.
+    def add(self, due, agent, command):
+        entry = None
+
+        with self.condition:
+            entry = (due, self.next_id, agent, command)
+            self.next_id += 1
+            if self.database:
+                with self.database:
+                    self.database.execute("INSERT INTO scheduled (id, due, agent, command) VALUES (?, ?, ?, ?)",
+                        (entry[1], due, agent, command))
+            heapq.heappush(self.heap, entry)
+
+            # Only wake up the thread if its alarm has to go off sooner.
+            if self.heap[0] is entry:
+                self.condition.notify()
+        return
+
+    # Return the number of scheduled commands and the time the next one is
+    # due (or None if there aren't any).
+    def pending(self):
+        with self.condition:
+            if not self.heap:
+                return (0, None)
+            return (len(self.heap), self.heap[0][0])
+
+    # Start the thread that adds commands to their queues when they're due.
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="scheduler",
+            daemon=True)
+        self.thread.start()
+        return
+
+    # Shut down the thread and close the database.
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        if self.database:
+            self.database.close()
+        return
+
+    # The scheduler thread.  Sleeps until the earliest command is due (or a
+    # new one is added that's due sooner), then releases every command that's
+    # due.
+    def _run(self):
+        delay = 0.0
+
+        with self.condition:
+            while not self.stopping:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                self._release_due()
+        return
+
+    # Add every command that's due to its agent's message queue.  The caller
+    # has to be holding the condition variable.
+    def _release_due(self):
+        now = time.time()
+        released = []
+        retry = []
+        due = 0.0
+        entry_id = 0
+        agent = ""
+        command = ""
+
+        while self.heap and self.heap[0][0] <= now:
+            due, entry_id, agent, command = heapq.heappop(self.heap)
+
+            # On a hub, the agent might live on a leaf that hasn't connected
+            # since the hub started.
+            if agent not in message_queue.message_queue and federation.allowed_leaves:
+                logging.info("Agent %s doesn't have a queue yet, trying scheduled command again in %d seconds." %
+                    (agent, self.retry_interval))
+                retry.append((now + self.retry_interval, entry_id, agent,
+                    command))
+                continue
+            if agent not in message_queue.message_queue:
+                logging.warning("Dropping scheduled command for agent %s, which doesn't exist anymore: %s" %
+                    (agent, command))
+                released.append((entry_id,))
+                continue
+            try:
+                message_queue.message_queue[agent].put(command,
+                    tracing.new_trace(agent, now))
+            except message_queue.QueueFull:
+                logging.warning("Agent %s's queue is full, trying scheduled command again in %d seconds." %
+                    (agent, self.retry_interval))
+                retry.append((now + self.retry_interval, entry_id, agent,
+                    command))
+                continue
+            logging.debug("Released scheduled command to agent %s: %s" %
+                (agent, command))
+            released.append((entry_id,))
+
+        for entry in retry:
+            heapq.heappush(self.heap, entry)
+        if self.database:
+            try:
+                with self.database:
+                    self.database.executemany("DELETE FROM scheduled WHERE id = ?",
+                        released)
+                    self.database.executemany("UPDATE scheduled SET due = ? WHERE id = ?",
+                        [(entry[0], entry[1]) for entry in retry])
+            except sqlite3.Error as e:
+                logging.error("Unable to update the schedule %s: %s" %
+                    (self.path, e))
+        return
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# trace_report.py - Reads the trace files written by the XMPP bridge (see
+#   trace_file in the config file) and prints the 50th, 95th, and 99th
+#   percentile of how long each step of a command's round trip took, for each
+#   agent:
+#
+#   queue wait - From being added to the queue to being picked up by the bot.
+#   bot - From being picked up to the bot's reply coming in.
+#   reply send - From the reply coming in to it being sent over XMPP.
+#   total - From the command coming in over XMPP to the reply going out.
+#
+#   Traces that never got a reply only count toward the steps they made it
+#   through.  If it's given the current trace file, the rotated ones next to
+#   it (trace file.1, .2...) are read too.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+import argparse
+import glob
+import json
+import math
+import sys
+
+# The steps of a round trip: the name, and the hops it starts and ends at.
+steps = [
+    ("queue wait", "enqueued", "dequeued"),
+    ("bot", "dequeued", "reply received"),
+    ("reply send", "reply received", "sent"),
+    ("total", "received", "sent")
+    ]
+
+# read_traces(): Read every trace out of a list of trace files.  Lines that
+#   aren't valid JSON (like one cut off by a crash) are skipped.  Returns a
+#   list of hash tables.
+def read_traces(paths):
+    traces = []
+
+    for path in paths:
+        with open(path) as trace_file:
+            for line in trace_file:
+                try:
+                    traces.append(json.loads(line))
+                except ValueError:
+                    continue
+    return traces
+
+# percentile(): Nearest-rank percentile of a sorted list.  Takes the list and
+#   the percentile (0 to 100).
+def percentile(values, p):
+    return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+# report(): Break the traces down by agent and step.  Returns a hash table of
+#   hash tables: agent -> step -> sorted list of durations in seconds.
+def report(traces):
+    durations = {}
+
+    for trace in traces:
+        agent = durations.setdefault(trace.get("agent", "unknown"), {})
+        for name, start, end in steps:
+            if start in trace and end in trace:
+                agent.setdefault(name, []).append(trace[end] - trace[start])
+    for agent in durations.values():
+        for values in agent.values():
+            values.sort()
+    return durations
+
+# Core code...
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Prints a breakdown of where the time goes between a command being sent to the XMPP bridge and the bot's reply coming back.")
+    argparser.add_argument("trace_files", nargs="+",
+        help="Trace files written by the XMPP bridge.")
+    args = argparser.parse_args()
+
+    paths = []
+    for path in args.trace_files:
+        paths.append(path)
+        paths.extend(sorted(glob.glob(glob.escape(path) + ".[0-9]*"),
+            reverse=True))
+    paths = list(dict.fromkeys(paths))
+
+    traces = read_traces(paths)
+    if not traces:
+        print("No traces found.")
+        sys.exit(1)
+
+    print("%d traces." % len(traces))
+    print("%-20s %-12s %8s %10s %10s %10s" % ("agent", "step", "count",
+        "p50", "p95", "p99"))
+    for agent, breakdown in sorted(report(traces).items()):
+        for name, start, end in steps:
+            if name not in breakdown:
+                continue
+            values = breakdown[name]
+            print("%-20s %-12s %8d %9.3fs %9.3fs %9.3fs" % (agent, name,
+                len(values), percentile(values, 50), percentile(values, 95),
+                percentile(values, 99)))
+    sys.exit(0)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim: set expandtab tabstop=4 shiftwidth=4 :
+
+# tracing.py - A module of the Exocortex XMPP Bridge that follows commands
+#   from the moment they come in over XMPP to the moment the bot's reply goes
+#   back out, so that it's possible to figure out where the time goes.
+#
+#   Every command gets a trace ID, which is handed to the bot along with the
+#   command.  If the bot sends the trace ID back with its reply, the whole
+#   round trip can be put together.  The time of each hop is written down:
+#
+#   received - The command arrived over XMPP.
+#   enqueued - The command was added to the agent's message queue.
+#   dequeued - The bot picked the command up.
+#   reply received - The bot's first reply with the trace ID was PUT to
+#       /replies.
+#   sent - That reply was sent to the bot's owner over XMPP.
+#
+#   When a trace is finished (or gives up waiting for a reply), it's written
+#   as one line of JSON to a log file that gets rotated.  trace_report.py
+#   reads those files and breaks the latencies down.
+#
+#   This is part of the Exocortex Halo project
+#   (https://github.com/virtadpt/exocortex-halo/).
+
+# v1.0 - Initial release.
+
+# TODO:
+# -
+
+# By: The Doctor <drwho at virtadpt dot net>
+#     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
+
+# License: GPLv3
+
+from collections import OrderedDict
+
+import json
+import logging
+import logging.handlers
+import sys
+import threading
+import time
+import uuid
+
+# The hops of a trace, in order.
+hops = ["received", "enqueued", "dequeued", "reply received", "sent"]
+
+# Handle to the logger that writes finished traces.  None if tracing isn't
+# turned on, in which case everything else in this module does nothing.
+trace_log = None
+
+# Traces that haven't finished yet, keyed by trace ID, oldest first.
+pending = OrderedDict()
+lock = threading.Lock()
+
+# Number of seconds a trace waits for a reply before it's written out
+# without one.
+max_age = 3600
+
+# Upper limit on the number of traces that can be waiting for replies.  Past
+# this, the oldest ones are written out without replies.
+max_pending = 10000
+
+# start(): Turn tracing on.  Takes three args, the path to the trace file, the
+#   size (in bytes) it can grow to before it's rotated, and the number of old
+#   trace files to keep around.
+def start(path, max_bytes=10485760, backups=5):
+    global trace_log
+    handler = None
+
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+        backupCount=backups)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_log = logging.getLogger("exocortex_xmpp_bridge.traces")
+    trace_log.setLevel(logging.INFO)
+    trace_log.propagate = False
+    trace_log.addHandler(handler)
+    logging.info("Writing traces to %s." % path)
+    return
+
+# new_trace(): Start a trace for a command that just came in.  Takes two
+#   args, the name of the agent the command is for and the time it was
+#   received (from time.time()).  Returns the trace ID, or None if tracing
+#   isn't turned on.
+def new_trace(agent, received):
+    trace_id = None
+
+    if not trace_log:
+        return None
+    trace_id = uuid.uuid4().hex[:16]
+    with lock:
+        pending[trace_id] = {"trace": trace_id, "agent": agent,
+            "received": received}
+        _expire()
+    return trace_id
+
+# mark(): Write down the time a trace reached one of its hops.  Only the
+#   first time counts, so a command that goes back into its queue after a
+#   lease runs out keeps the time it was first picked up.  Takes two args,
+#   the trace ID and the name of the hop.  Unknown trace IDs (like ones a bot
+#   made up, or ones from before the bridge was restarted) are ignored.
+def mark(trace_id, hop):
+    if not trace_log:
+        return
+    with lock:
+        if trace_id in pending:
+            pending[trace_id].setdefault(hop, time.time())
+    return
+
+# finish(): Write down the time a trace reached its last hop and write the
+#   trace to the trace file.  Takes one arg, the trace ID.
+def finish(trace_id):
+    trace = None
+
+    if not trace_log:
+        return
+    with lock:
+        trace = pending.pop(trace_id, None)
+    if trace:
+        trace["sent"] = time.time()
+        trace_log.info(json.dumps(trace))
+    return
+
+# Write out every trace that's been waiting too long for a reply (or that
+# there's no more room for).  The caller has to be holding the lock.
+def _expire():
+    cutoff = time.time() - max_age
+    trace = None
+
+    while pending:
+        trace = next(iter(pending.values()))
+        if trace["received"] > cutoff and len(pending) <= max_pending:
+            break
+        pending.popitem(last=False)
+        trace_log.info(json.dumps(trace))
+    return
+
+if "__name__" == "__main__":
+    print("No self tests yet.")
+    sys.exit(0)
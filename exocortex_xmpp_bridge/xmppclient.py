@@ -8,6 +8,50 @@
 #   This is part of the Exocortex Halo project
 #   (https://github.com/virtadpt/exocortex-halo/).
 
+# v6.13 - A command that's the same as one sent to the same agent a moment
+#        ago (dedup.py) is acknowledged but not added to the agent's queue
+#        again.
+# v6.12 - Replies too big for one message (max_stanza_bytes) are split on line
+#        boundaries into numbered parts, which go out through the token
+#        bucket like any other message.
+# v6.11 - "Robots, report." sends a summary of every queue (how many commands
+#        are waiting, how old the oldest one is, and the next few) instead
+#        of every command in every queue.  Added "report <agent> page <n>"
+#        for paging through one agent's queue.
+# v6.10 - Agent names are looked up in the routing index, so they match no
+#        matter how they're capitalized, by alias, or with one typo.  The
+#        acknowledgement says which agent the command went to (and actually
+#        gets sent now, instead of an empty message).
+# v6.9 - Commands that start with "at HH:MM" or "in N minutes" are handed
+#        to the scheduler instead of going straight into the agent's queue.
+#        The status report says how many commands are scheduled.
+# v6.8 - If an agent's message queue is full, the command is refused and the
+#        bot's owner is told so.
+# v6.7 - Every command gets a trace ID when it comes in (if tracing is
+#        turned on), and the trace is finished when the first reply that
+#        carries it goes out.
+# v6.6 - Records how long every reply waited between being PUT to /replies
+#        and being sent, for the /metrics rail.
+# v6.5 - Rewrote XMPPClient.on_disconnect().  It used to call time.sleep() in
+#        a loop, which froze SliXMPP's event loop (and everything scheduled on
+#        it) until the connection came back.  Now it starts an asyncio task
+#        that tries to reconnect with capped exponential backoff and jitter.
+#        Replies pile up in the replies queue while the bridge is offline and
+#        go out in a burst as soon as the session comes back.
+#      - session_resumed no longer kicks off a reconnection; it means the
+#        connection is back.
+# v6.4 - Added an optional coalescing window.  Replies from the same bot that
+#        arrive within a few milliseconds of each other are merged into a
+#        single message (up to a maximum size) instead of being sent one at a
+#        time.
+# v6.3 - The replies queue is drained through a token bucket instead of one
+#        reply per second, so bursts of replies go out as fast as the XMPP
+#        server will allow.  The rate and burst size are configurable.
+#      - The status report includes the depth of the replies queue and the age
+#        of the oldest reply in it.
+# v6.2 - Uses the AgentQueue API in message_queue.py.
+# v6.1 - Commands are pushed into the message queues with
+#        message_queue.push() so that long-polling agents wake up right away.
 # v6.0 - SleekXMPP is dead.  Ported to SliXMPP
 #        (https://codeberg.org/poezio/slixmpp/).  This involved doing a lot of
 #        reworking of the XMPP client stuff, so I figure it's worth a major
@@ -67,21 +111,15 @@
 # v1.0 - Initial release.
 
 # TODO:
-# - Consider adding a SQLite database to serialize the message queues to in
-#   the event the microservice ABENDs or gets shut down.  Don't forget a
-#   scream-and-die error message to not leave the user hanging.
 # - Maybe add a signal handler that'll cause the bot to dump its message queues
 #   to the database without dying?
-# - Figure out how to make slightly-mistyped search agent names (like all-
-#   lowercase instead of proper capitalization, or proper capitalization
-#   instead of all caps) match when search requests are pushed into the
-#   message queue.  I think I can do this, I just need to play with it.
 
 # By: The Doctor <drwho at virtadpt dot net>
 #     0x807B17C1 / 7960 1CDC 85C9 0B63 8D9F  DD89 3BD8 FF2B 807B 17C1
 
 # License: GPLv3
 
+from collections import deque
 from slixmpp import ClientXMPP
 from slixmpp.exceptions import IqError, IqTimeout
 
@@ -90,7 +128,12 @@ import logging
 import random
 import time
 
+import dedup
 import message_queue
+import metrics
+import ratelimiter
+import scheduler
+import tracing
 
 # XMPPClient: XMPP client class.  Internally, this has changed a great deal
 #   because I migrated the code to SliXMPP, which doesn't use threading anymore
@@ -112,8 +155,62 @@ class XMPPClient(ClientXMPP):
     # Default stanza type to make the bridge work reliably with more clients.
     stanza_type = "chat"
 
-    # Initialize new instances of the class.
-    def __init__(self, username, password, owner):
+    # How often (in seconds) the replies queue is checked for replies to send.
+    replies_interval = 0.1
+
+    # Token bucket that paces how fast replies are sent to the XMPP server.
+    replies_bucket = None
+
+    # Replies from the same bot that arrive within this many seconds of each
+    # other are merged into one message.  0 turns this off.
+    coalesce_window = 0.0
+
+    # Largest message body (in bytes) the bridge will build when merging
+    # replies.
+    max_stanza_bytes = 8192
+
+    # Most replies that will be looked at for merging at any one time.
+    max_coalesce = 50
+
+    # Messages waiting for tokens from the token bucket, as (message, queue
+    # entries) tuples.  This is where the parts of a reply that's too big for
+    # one message wait their turn.  The queue entries the message was made
+    # from go with its first part.
+    outbound = None
+
+    # Whether or not the bridge has a working XMPP session right now.  Replies
+    # aren't sent unless it does.
+    online = False
+
+    # asyncio.Event that's set whenever the bridge has a working session, so
+    # the reconnection task can wait on it.
+    online_event = None
+
+    # Handle to the task that's trying to reconnect, if there is one.
+    reconnect_task = None
+
+    # Number of commands from each queue shown in a status report, number of
+    # commands per page of a detailed report, and the number of characters of
+    # each command that are shown.
+    report_preview = 3
+    report_page_size = 10
+    report_item_length = 80
+
+    # Backoff between reconnection attempts, in seconds: the first attempt
+    # waits about reconnect_base seconds and every attempt after that waits
+    # about twice as long as the last one, up to reconnect_cap.  Each attempt
+    # gets reconnect_timeout seconds to set up a session before it's
+    # considered failed.
+    reconnect_base = 1.0
+    reconnect_cap = 300.0
+    reconnect_timeout = 30.0
+
+    # Initialize new instances of the class.  replies_rate is the number of
+    # replies per second that can be sent to the owner over the long run, and
+    # replies_burst is how many can go out back to back after a quiet spell.
+    # coalesce_window is in milliseconds.
+    def __init__(self, username, password, owner, replies_rate=5,
+            replies_burst=10, coalesce_window=0, max_stanza_bytes=8192):
         logging.debug("Entered xmppclient.XMPPClient.__init__().")
 
         # Store the username, password and nickname as local attributes.
@@ -127,6 +224,22 @@ class XMPPClient(ClientXMPP):
         logging.debug("Construct's XMPP nickname: " + self.nickname)
         logging.debug("Construct's owner: " + self.owner)
 
+        # Set up the rate limiter for the replies queue.
+        self.replies_bucket = ratelimiter.TokenBucket(replies_rate,
+            replies_burst)
+        logging.debug("Sending up to %s replies per second in bursts of up to %s." %
+            (replies_rate, replies_burst))
+
+        # Set up the flag the reconnection task waits on.
+        self.online_event = asyncio.Event()
+
+        # Set up reply coalescing and splitting.
+        self.coalesce_window = coalesce_window / 1000.0
+        self.max_stanza_bytes = max_stanza_bytes
+        self.outbound = deque()
+        logging.debug("Coalescing window: %s seconds, maximum message size: %s bytes." %
+            (self.coalesce_window, self.max_stanza_bytes))
+
         # Log into the server.
         logging.debug("Logging into the XMPP server...")
         ClientXMPP.__init__(self, username, password)
@@ -148,11 +261,11 @@ class XMPPClient(ClientXMPP):
         # possible.
         self.add_event_handler("disconnected", self.on_disconnect)
         self.add_event_handler("killed", self.on_disconnect)
-        self.add_event_handler("session_resumed", self.on_disconnect)
+        self.add_event_handler("session_resumed", self.on_session_resumed)
 
         # Start the /replies processing task now that we're logged in.
-        self.schedule("replies_processor", 1, self.process_replies_queue,
-            repeat=True)
+        self.schedule("replies_processor", self.replies_interval,
+            self.process_replies_queue, repeat=True)
 
     # Fires when the construct isn't able to authenticate with the server.
     def failed_auth(self, event):
@@ -173,6 +286,7 @@ class XMPPClient(ClientXMPP):
         logging.debug("Sending the bot's session presence to the server and requesting the roster.")
         self.send_presence()
         self.get_roster()
+        self._go_online()
 
         # Construct a message for the bot's owner that consists of the list of
         # bots that access the message bridge, along with appropriate
@@ -202,9 +316,16 @@ class XMPPClient(ClientXMPP):
     def message(self, received_message):
         message_sender = str(received_message.get_from()).strip().split("/")[0]
         message_body = str(received_message["body"]).strip()
+        received = time.time()
         agent_name = ""
+        typed_name = ""
         command = ""
         acknowledgement = ""
+        trace_id = None
+        due = None
+        words = []
+        request = ""
+        age = None
 
         logging.debug("Value of XMPPClient.message().message_sender is: %s" %
             message_sender)
@@ -239,6 +360,16 @@ class XMPPClient(ClientXMPP):
             self._status_report()
             return
 
+        # The user is asking for a detailed report on one agent's queue:
+        # "report <agent>" or "report <agent> page <n>".
+        words = message_body.rstrip(".").split()
+        if len(words) in (2, 4) and words[0].lower() == "report" and \
+                message_queue.resolve(words[1]) and (len(words) == 2 or
+                (words[2].lower() == "page" and words[3].isdigit())):
+            self._queue_report(message_queue.resolve(words[1]),
+                int(words[3]) if len(words) == 4 else 1)
+            return
+
         # Try to split off the bot's name from the message body.  If the
         # agent's name isn't registered, bounce.
         if "," in message_body:
@@ -247,12 +378,17 @@ class XMPPClient(ClientXMPP):
             agent_name = message_body.split(" ")[0]
         logging.debug("Agent name: %s" % agent_name)
 
-        if agent_name not in list(message_queue.message_queue.keys()):
-            response = "Request sent to agent " + agent_name + ", which doesn't exist on this bot.  Please check your spelling."
+        typed_name = agent_name.strip()
+        agent_name = message_queue.resolve(typed_name)
+        if not agent_name:
+            response = "Request sent to agent " + typed_name + ", which doesn't exist on this bot.  Please check your spelling."
             logging.debug(response)
             self.send_message(mto=self.owner, mbody=response,
                 mtype=self.stanza_type)
             return
+        if agent_name != typed_name:
+            logging.debug("Agent name %s resolved to %s." % (typed_name,
+                agent_name))
 
         # Extract the command from the message body and clean it up.
         if "," in message_body:
@@ -263,13 +399,46 @@ class XMPPClient(ClientXMPP):
         command = command.strip(".")
         logging.debug("Received request: %s" % command)
 
+        # If the same command was just sent to the same agent it's probably a
+        # double-tap or a flaky client sending it again, so don't run it
+        # twice.
+        age = dedup.seen(agent_name, command)
+        if age is not None:
+            response = "You sent that to " + agent_name + " %d seconds ago, so it wasn't added to the request queue again." % age
+            logging.info(response)
+            self.send_message(mto=self.owner, mbody=response,
+                mtype=self.stanza_type)
+            return
+        request = command
+
+        # If the command is supposed to be run later, hand it to the scheduler.
+        if scheduler.schedule:
+            due, command = scheduler.parse_schedule(command, received)
+        if due:
+            scheduler.schedule.add(due, agent_name, command)
+            dedup.remember(agent_name, request)
+            response = "Your request will be added to " + agent_name + "'s request queue at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(due)) + "."
+            logging.debug(response)
+            self.send_message(mto=self.owner, mbody=response,
+                mtype=self.stanza_type)
+            return
+
         # Push the request into the appropriate message queue.
-        message_queue.message_queue[agent_name].append(command)
+        trace_id = tracing.new_trace(agent_name, received)
+        try:
+            message_queue.message_queue[agent_name].put(command, trace_id)
+        except message_queue.QueueFull:
+            response = "Agent " + agent_name + "'s request queue is full.  Please try again later."
+            logging.warning(response)
+            self.send_message(mto=self.owner, mbody=response,
+                mtype=self.stanza_type)
+            return
         logging.debug("Added request to %s's message queue." % agent_name)
+        dedup.remember(agent_name, request)
 
         # Tell the bot's owner that the request has been added to the agent's
         # message queue.
-        acknowledgment = "Your request has been added to " + agent_name + "'s request queue."
+        acknowledgement = "Your request has been added to " + agent_name + "'s request queue."
         logging.debug(acknowledgement)
         self.send_message(mto=self.owner, mbody=acknowledgement,
             mtype=self.stanza_type)
@@ -283,9 +452,12 @@ class XMPPClient(ClientXMPP):
         help_text = """
 Supported commands:\n
 - help - This online help.\n
-- Robots, report. - List all constructs this bot is configured to communicate with.\n
+- Robots, report. - List all constructs this bot is configured to communicate with, and what's waiting for them.\n
+- report [bot name] page [n] - List the commands waiting for one construct, a page at a time.\n
 To send a command to one of the constructs, use your XMPP client to send a message that looks something like this:\n
 "[bot name], do this thing for me."\n
+To have the command run later, start it with "at HH:MM" or "in N minutes" (or seconds, hours, or days):\n
+"[bot name], at 02:00 do this thing for me."\n
 Individual constructs may have their own online help, so try sending the command "[bot name], help."\n
             """
 
@@ -294,89 +466,293 @@ Individual constructs may have their own online help, so try sending the command
         return
 
     # Helper method that returns a status report when queried.
+    # Only the first few commands in each queue are listed so that the report
+    # stays small no matter how far behind the agents are.
     def _status_report(self):
         logging.debug("Entering XMPPClient._status_report().")
         response = "Contents of message queues are as follows:\n\n"
+        queue = None
+        depth = 0
         for key in list(message_queue.message_queue.keys()):
             if key == "replies":
                 continue
+            queue = message_queue.message_queue[key]
+            depth = queue.depth()
             response = response + "Agent " + key + ": "
-            response = response + str(message_queue.message_queue[key]) + "\n"
+            if not depth:
+                response = response + "nothing waiting\n"
+                continue
+            response = response + "%d waiting, oldest %.1f seconds\n" % (
+                depth, queue.oldest_age())
+            for entry in queue.peek(self.report_preview):
+                response = response + "    " + self._shorten(entry.item) + "\n"
+            if depth > self.report_preview:
+                response = response + "    (and %d more; send \"report %s page 1\" to see them)\n" % (
+                    depth - self.report_preview, key)
+        response = response + "\nReplies waiting to be sent: %d (oldest %.1f seconds)\n" % (
+            message_queue.message_queue["replies"].depth(),
+            message_queue.message_queue["replies"].oldest_age())
+        if scheduler.schedule:
+            count, due = scheduler.schedule.pending()
+            response = response + "Scheduled commands: %d" % count
+            if due:
+                response = response + " (next at " + time.strftime("%Y-%m-%d %H:%M", time.localtime(due)) + ")"
+            response = response + "\n"
+        self.send_message(mto=self.owner, mbody=response,
+            mtype=self.stanza_type)
+        return
+
+    # Helper method that sends one page of the commands waiting in an agent's
+    # queue.  Takes two args, the name of the agent and the page number
+    # (starting with 1).
+    def _queue_report(self, agent, page):
+        logging.debug("Entering XMPPClient._queue_report().")
+        queue = message_queue.message_queue[agent]
+        depth = queue.depth()
+        pages = max(1, -(-depth // self.report_page_size))
+        start = 0
+        response = ""
+
+        page = min(max(page, 1), pages)
+        start = (page - 1) * self.report_page_size
+        response = "Agent %s: %d waiting, %d leased, %d added and %d taken out since startup.  Page %d of %d:\n\n" % (
+            agent, depth, queue.leased(), queue.enqueued, queue.dequeued,
+            page, pages)
+        for i, entry in enumerate(queue.peek(self.report_page_size, start)):
+            response = response + "%d. %s\n" % (start + i + 1,
+                self._shorten(entry.item))
+        if not depth:
+            response = response + "Nothing waiting.\n"
         self.send_message(mto=self.owner, mbody=response,
             mtype=self.stanza_type)
         return
 
-    # Thread that wakes up every n seconds and processes the bot's private
-    # message queue (/replies).  If there are any, picks the least recently
-    # used one out and sends it to the bot's owner.
+    # Helper method that cuts a command down to report_item_length characters
+    # for reports.
+    def _shorten(self, item):
+        item = str(item)
+        if len(item) > self.report_item_length:
+            return item[:self.report_item_length - 3] + "..."
+        return item
+
+    # Scheduled task that wakes up every replies_interval seconds and
+    # processes the bot's private message queue (/replies).  Sends replies to
+    # the bot's owner in the order they came in, as many at a time as the
+    # token bucket has tokens for.  Runs of replies from the same bot are
+    # merged into a single message if coalescing is turned on, and replies
+    # that are too big for one message are split into parts.
     def process_replies_queue(self):
-        logging.debug("Entering XMPPClient.process_replies_queue().")
-        if len(message_queue.message_queue["replies"]):
-            reply = message_queue.message_queue["replies"].pop(0)
-            self.send_message(mto=self.owner, mbody=reply,
+        replies = message_queue.message_queue["replies"]
+        entries = []
+        count = 0
+        sent = 0
+        message = ""
+
+        # Replies stay in the queue while the bridge is offline.
+        if not self.online:
+            return
+
+        while self.outbound or replies.depth():
+
+            # Parts of a big reply that are already waiting go out before
+            # anything else is taken out of the queue.
+            if not self.outbound:
+                entries = replies.peek(self.max_coalesce)
+                if not entries:
+                    break
+                count = self._coalesce(entries)
+
+                # If every reply waiting is part of this run and the
+                # coalescing window is still open, hold off in case more show
+                # up.
+                if count == replies.depth() and (time.monotonic() -
+                        entries[0].enqueued) < self.coalesce_window:
+                    break
+
+            if not self.replies_bucket.consume():
+                break
+            if not self.outbound:
+                for i, message in enumerate(self._split_replies(
+                        replies.get_many(count))):
+                    self.outbound.append((message,
+                        entries[:count] if i == 0 else []))
+
+            message, entries = self.outbound.popleft()
+            self.send_message(mto=self.owner, mbody=message,
                 mtype=self.stanza_type)
+            sent += 1
+            for entry in entries:
+                metrics.reply_latency.record(time.monotonic() - entry.enqueued)
+                if "trace" in entry.item:
+                    tracing.finish(entry.item["trace"])
+
+        if sent:
+            logging.debug("Sent %d messages.  %d parts and %d replies left to send, oldest is %.1f seconds old." %
+                (sent, len(self.outbound), replies.depth(),
+                replies.oldest_age()))
+        return
+
+    # Figure out how many of the replies at the front of the replies queue can
+    # be merged into one message: they have to be from the same bot, arrive
+    # within the coalescing window of the first one, and fit into
+    # max_stanza_bytes.  Takes a list of queue entries.  Returns the number of
+    # entries to merge, which is always at least one.
+    def _coalesce(self, entries):
+        first = entries[0]
+        size = len(self._format_replies([first.item]).encode())
+        count = 1
+
+        if not self.coalesce_window:
+            return 1
+
+        for entry in entries[1:]:
+            if entry.item["name"] != first.item["name"]:
+                break
+            if entry.enqueued - first.enqueued > self.coalesce_window:
+                break
+            size = size + len(("\n\n%s" % entry.item["reply"]).encode())
+            if size > self.max_stanza_bytes:
+                break
+            count += 1
+        return count
+
+    # Turn one or more replies from the same bot into a message for the bot's
+    # owner.  Takes a list of replies.  Returns a string.
+    def _format_replies(self, replies):
+        message = "Got a message from %s:\n\n" % replies[0]["name"]
+        message = message + "\n\n".join(["%s" % i["reply"] for i in replies])
+        return message
+
+    # Turn one or more replies from the same bot into as many messages as it
+    # takes to keep each one under max_stanza_bytes.  Replies are split
+    # between lines where possible (lines that are too long by themselves are
+    # split wherever they have to be) and each part is numbered.  Takes a list
+    # of replies.  Returns a list of strings.
+    def _split_replies(self, replies):
+        message = self._format_replies(replies)
+        header = "Got a message from %s (%d/%d):\n\n"
+        limit = 0
+        lines = []
+        parts = []
+        part = []
+        size = 0
+        length = 0
+
+        if len(message.encode("utf-8")) <= self.max_stanza_bytes:
+            return [message]
+
+        # Leave room for the header, whatever the part numbers turn out to be.
+        limit = max(self.max_stanza_bytes -
+            len((header % (replies[0]["name"], 99999, 99999)).encode("utf-8")),
+            64)
+        for line in "\n\n".join(["%s" % i["reply"] for i in replies]).split("\n"):
+            lines.extend(self._split_line(line, limit))
+
+        for line in lines:
+            length = len(line.encode("utf-8"))
+            if part and size + 1 + length > limit:
+                parts.append("\n".join(part))
+                part = []
+                size = 0
+            size = size + length + (1 if part else 0)
+            part.append(line)
+        parts.append("\n".join(part))
+
+        return [header % (replies[0]["name"], i + 1, len(parts)) + part
+            for i, part in enumerate(parts)]
+
+    # Cut a line that's longer than limit bytes into pieces that aren't,
+    # without cutting any UTF-8 characters in half.  Returns a list of
+    # strings.
+    def _split_line(self, line, limit):
+        encoded = line.encode("utf-8")
+        pieces = []
+        cut = 0
+
+        while len(encoded) > limit:
+            cut = limit
+            while cut and (encoded[cut] & 0xC0) == 0x80:
+                cut -= 1
+            pieces.append(encoded[:cut].decode("utf-8"))
+            encoded = encoded[cut:]
+        pieces.append(encoded.decode("utf-8"))
+        return pieces
+
+    # Fires when XEP-0198 stream management picks an interrupted session back
+    # up, which means the bridge is back online.
+    def on_session_resumed(self, event):
+        logging.info("XMPP session resumed.")
+        self._go_online()
+        return
+
+    # Mark the bridge as online and send everything that piled up in the
+    # replies queue while it wasn't, as fast as the rate limiter allows.
+    def _go_online(self):
+        self.online = True
+        self.online_event.set()
+        self.replies_bucket.reset()
+        if message_queue.message_queue["replies"].depth():
+            logging.info("Sending %d replies that came in while the bridge was offline." %
+                message_queue.message_queue["replies"].depth())
+            self.process_replies_queue()
         return
 
-    # Fires whenever the bot's connection dies.  I need to figure out how to
-    # make the bot wait for a random period of time and then try to reconnect
-    # to the server.
-    # What this is supposed to do is manually tear down the connection if it
-    # dies (which is a belt-and-suspenders kind of thing, to make sure the
-    # internal state is consistent) and then start it up again.
+    # Fires whenever the bot's connection dies.  Marks the bridge as offline
+    # (so replies are held in the replies queue instead of being thrown at a
+    # dead connection) and starts a task that tries to reconnect, unless one is
+    # already running.  This has to return right away because it runs on the
+    # same event loop as everything else.
     def on_disconnect(self, event):
         logging.debug("Entering XMPPClient.on_disconnect().")
+        self.online = False
+        self.online_event.clear()
+
+        if self.reconnect_task and not self.reconnect_task.done():
+            logging.debug("Already trying to reconnect.")
+            return
+
         logging.info("Connection to XMPP server disappeared.  Attempting to reconnect to JID %s." % self.username)
+        self.reconnect_task = asyncio.ensure_future(self._reconnect(),
+            loop=self.loop)
+        return
 
-        # This holds the random period of time the bot will sleep during
-        # reconnection attempts.  It's kept in a variable because the value
-        # will be referenced in user output, so it shouldn't change.
-        random_sleep = 0.0
+    # Task that tries to reconnect to the server until it gets a working
+    # session back.  Waits a while between attempts to give the network
+    # connection(s) a chance to stabilize.  The specific use case I'm thinking
+    # of is a laptop that has to get back on the local wireless network and
+    # then re-negotiate a VPN connection, which can take a while.  The wait
+    # doubles after every failed attempt (up to a limit) and is randomized a
+    # bit so that a bunch of bridges that lost the same server don't all hit
+    # it at the same moment when it comes back.
+    async def _reconnect(self):
+        attempt = 0
+        delay = 0.0
 
         # Initialize the RNG from the current system time.  We're not
         # generating a cryptographic key or anything, so we can do this.
         random.seed()
 
-        # Start a loop in which the bot will attempt to reconnect until it is
-        # either successful or the user gives up and shuts the bot down.
-        while True:
-
-            # Force a disconnection attempt in case the XMPPClient's internal
-            # state needs it.
-            logging.debug("Forcing a disconnection.")
-            self.disconnect(reason="Just woke up, trying again.")
-
-            # Sleep for a random number of seconds (between 1 and 10, at a
-            # guess) to give the network connection(s) a chance to stabilize.
-            # The specific use case I'm thinking of is a laptop that has to
-            # get back on the local wireless network and then re-negotiate a
-            # VPN connection.  This can take a while from the user's (and thus
-            # the bot's) point of view.
-            random_sleep = random.randint(1, 10)
-            logging.debug("Going to sleep for %s seconds." % random_sleep)
-            time.sleep(random_sleep)
-            logging.debug("Woke up after %s seconds." % random_sleep)
-
-            # Try reconnecting.  Re-use the random sleep as the timeout just
-            # because we can.
+        while not self.online:
+            delay = min(self.reconnect_cap,
+                self.reconnect_base * (2 ** attempt))
+            delay = random.uniform(delay / 2, delay)
+            logging.debug("Going to wait %.1f seconds before reconnecting." %
+                delay)
+            await asyncio.sleep(delay)
+
             logging.info("Attempting to reconnect.")
-            self.reconnect(wait=random_sleep, reason="Just woke up.")
+            self.connect()
 
-            # Test the connection by sending the bot's presence and pulling its
-            # roster.  We have to do this after a login anyway, so it kills
-            # two birds with one stone.
+            # Wait for the session to start.  session_start() marks the
+            # bridge as online when it does.
             try:
-                logging.debug("Pinging the server by sending a presence request and pulling the JID's roster.")
-                self.send_presence()
-                self.get_roster()
-
-                # If the above two calls worked, break out of the loop because
-                # login was successful.
-                logging.info("Re-login successful!")
-                break
-            except:
-                logging.warn("Re-login attempt failed.")
+                await asyncio.wait_for(self.online_event.wait(),
+                    self.reconnect_timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Re-login attempt %d failed." % (attempt + 1))
+                attempt += 1
 
-        logging.debug("Bounced out of the re-login attempt loop, exiting XMPPClient.on_disconnect().")
+        logging.info("Re-login successful!")
         return
 
 if "__name__" == "__main__":
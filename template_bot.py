@@ -12,6 +12,10 @@
 
 # License: GPLv3
 
+# v1.5 - Keeps the trace ID that comes with every command and sends it back
+#        with every reply, so the XMPP bridge can trace the whole round trip.
+# v1.4 - If the message queue URL starts with http+unix://, talk to the XMPP
+#        bridge over its Unix domain socket (needs requests-unixsocket).
 # v1.3 - Updated some comments and boilerplate.
 #      - Changed ConfigParser to configparser, per Python 3 and PEP-8.
 # v1.2 - Changed logging.warn() to logging.warning().
@@ -69,6 +73,10 @@ polling_time = 10
 # String that holds the command from the user prior to parsing.
 user_command = None
 
+# Trace ID the XMPP bridge sent along with the command, if it's tracing.  It's
+# sent back with every reply to that command.
+trace = None
+
 # Handle to a parsed user command.
 parsed_command = None
 
@@ -156,6 +164,8 @@ def send_message_to_user(message):
     reply = {}
     reply["name"] = bot_name
     reply["reply"] = message
+    if trace:
+        reply["trace"] = trace
 
     # Send an HTTP request to the XMPP bridge containing the message for the
     # user.
@@ -214,6 +224,17 @@ bot_name = config.get("DEFAULT", "bot_name")
 # Construct the full message queue URL.
 message_queue = server + bot_name
 
+# If the XMPP bridge is on the same machine and is being contacted over its
+# Unix domain socket (http+unix://%2Fpath%2Fto%2Fbridge.sock/), teach Requests
+# how to do that.
+if server.startswith("http+unix://"):
+    try:
+        import requests_unixsocket
+        requests_unixsocket.monkeypatch()
+    except ImportError:
+        logging.error("You need to install requests-unixsocket to talk to the XMPP bridge over a Unix domain socket.")
+        sys.exit(1)
+
 # Get the default loglevel of the bot.
 config_log = config.get("DEFAULT", "loglevel").lower()
 if config_log:
@@ -307,6 +328,7 @@ while True:
         # Extract the user command.
         user_command = json.loads(request.text)
         logging.debug("Value of user_command: " + str(user_command))
+        trace = user_command.get("trace")
         user_command = user_command["command"]
 
         # Parse the user command.